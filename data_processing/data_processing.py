@@ -32,6 +32,7 @@ import os
 from PyQt5 import QtWidgets, QtCore
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 from matplotlib.figure import Figure
+import measurement_ctrl.data_storage as data_storage
 
 matplotlib.use('Qt5Agg')
 
@@ -78,6 +79,7 @@ class DataProcessing(QtWidgets.QMainWindow):
         self.polar = None  # Bool value will be true if we need polar graph else rectangular graph
         self.s11 = None  # Bool value will be true if s11 measurements are present in data_file
         self.data_file = None  # File containing data recorded from measurement control
+        self.source = None  # LiveDataSource holding the rows of data_file read so far
         self.live = None  # Bool True if live measurements are being made
         self.plot_lines = []  # Array holding the callbacks values of lines on graphs
         self.plot_labels = []  # Array holding the label names of lines on graphs
@@ -86,6 +88,9 @@ class DataProcessing(QtWidgets.QMainWindow):
         self.num_of_frequencies = None  # Total number of frequencies present in the data_file
         self.radio = None  # Variable used for RadioButtons
         self.ani = None  # Variable used for animation method
+        self.live_freqs = []  # Frequencies of the lines updated in place during live plotting
+        self.live_lines = []  # Line2D objects updated in place during live plotting
+        self.background = None  # Canvas region behind the live lines, restored when blitting
         self.signals = Signals()  # Variable used to send signals back to the GUI
 
         # Create toolbar, passing canvas as first parameter, parent (self, the MainWindow) as second.
@@ -111,20 +116,23 @@ class DataProcessing(QtWidgets.QMainWindow):
         widget.setLayout(layout)
         self.setCentralWidget(widget)
         self.setSizePolicy(QtWidgets.QSizePolicy.Fixed, QtWidgets.QSizePolicy.Fixed)
+        self.sc.mpl_connect('draw_event', self.on_draw)
         # self.show()
 
-    def begin_measurement(self, data_file=None, polar=True, s11=False, is_live=None):
+    def begin_measurement(self, data_file=None, polar=True, s11=False, is_live=None, source=None):
         """
         This method will is called from the GUI when graphing needs to begin
         :param data_file: File location where data from measurement control is held
         :param polar: Bool value determining whether to graph polar or rectangular form
         :param s11: Bool value determining whether to graph s11 values or not
         :param is_live: Bool value determining whether plots are live updating
+        :param source: LiveDataSource for data_file; only new rows are read from the file
         :return: None
         """
         self.polar = polar
         self.s11 = s11
         self.data_file = data_file
+        self.source = source
         # self.sc.figure.clf()
 
         if is_live is None:
@@ -149,6 +157,330 @@ class DataProcessing(QtWidgets.QMainWindow):
         if not self.live:
             self.ani.event_source.stop()
 
+    def begin_live(self, data_file, polar, source, s11=False):
+        """
+        This method starts live plotting. The axes, lines and legend are created
+        once, then every refresh only updates the data of the existing lines
+        :param data_file: File location where data from measurement control is held
+        :param polar: Bool value determining whether to graph polar or rectangular form
+        :param source: LiveDataSource for data_file
+        :param s11: Bool value determining whether to graph s11 values or not
+        :return: None
+        """
+        self.polar = polar
+        self.s11 = s11
+        self.live = True
+        self.data_file = data_file
+        self.source = source
+        self.refresh_live()
+
+    def is_live_plot(self, data_file, polar, s11):
+        """
+        This method checks if the live plot can be refreshed in place
+        :return: Bool True if a live plot of the same file and format already exists
+        """
+        return self.live is True and self.source is not None and self.s11 == s11 and \
+            self.data_file == data_file and self.polar == polar
+
+    def refresh_live(self):
+        """
+        This method reads the new rows of the data file and redraws only the lines
+        :return: None
+        """
+        self.source.poll()
+        self.check_source_s11()
+        if self.s11:
+            self.refresh_impedance()
+            return
+        if not self.source.s21:
+            return
+        known = len(self.live_freqs)
+        if known == 0 or (known < 10 and len(self.source.s21) > known):
+            # First refresh with data, or more frequencies arrived; build the plot
+            self.create_live_plot()
+            self.update_live_lines()
+            self.sc.draw()
+            return
+        self.update_live_lines()
+        if self.background is None:
+            self.sc.draw()
+            return
+        self.sc.restore_region(self.background)
+        for line in self.live_lines:
+            self.sc.ax.draw_artist(line)
+        self.sc.blit(self.sc.ax.bbox)
+
+    def on_draw(self, event):
+        """
+        This method saves the plot without the live lines after every full redraw
+        (including resizes), so later refreshes only redraw the lines
+        :param event: matplotlib draw event
+        :return: None
+        """
+        if not self.live_lines or not self.live or self.s11:
+            self.background = None
+            return
+        self.background = self.sc.copy_from_bbox(self.sc.ax.bbox)
+        for line in self.live_lines:
+            self.sc.ax.draw_artist(line)
+
+    def update_live_lines(self):
+        """
+        This method sets the data of every live line from the LiveDataSource
+        :return: None
+        """
+        max_magnitude = self.source.max_magnitude
+        for freq, line in zip(self.live_freqs, self.live_lines):
+            phi_val_set, magnitude_val_set = self.source.s21_series(freq)
+            if max_magnitude > 0:
+                magnitude_val_set = magnitude_val_set + max_magnitude
+            else:
+                magnitude_val_set = magnitude_val_set - max_magnitude
+            magnitude_val_set = np.where(magnitude_val_set < -40, -40, magnitude_val_set)
+            if self.polar:
+                phi_val_set = np.radians(phi_val_set)
+            line.set_data(phi_val_set, magnitude_val_set)
+
+    def create_live_plot(self):
+        """
+        This method creates the axes, lines and legend of the S21 plot fed from the
+        LiveDataSource. Lines are only animated while live plotting
+        Polar or rectangular plot - Azimuth vs. Amplitude
+        :return: None
+        """
+        self.sc.figure.clf()
+        self.background = None
+        self.live_freqs = self.source.frequencies()[:10]
+        self.max_freq = self.live_freqs[-1]
+        mhz = self.mhz_or_ghz()  # Determines if lines should be represented in MHz or GHz
+        self.alt_labels = []
+
+        # Create subplot for graph window
+        if self.polar:
+            self.sc.ax = self.sc.figure.add_subplot(1, 64, (13, 64),
+                                                    projection='polar')
+        else:
+            self.sc.ax = self.sc.figure.add_subplot(64, 1, (1, 50))
+
+        # Add an empty line for every frequency; animated lines are left out
+        # of full redraws and drawn on top of the saved background
+        self.live_lines = []
+        for x, freq in enumerate(self.live_freqs):
+            current_freq_string = self.freq_string(freq, mhz)
+            line, = self.sc.ax.plot([], [],
+                                    label=current_freq_string,
+                                    color='C' + str(x % 10),
+                                    animated=self.live)
+            self.live_lines.append(line)
+            if self.polar:
+                self.alt_labels.append('\n' + current_freq_string + '\n')
+            else:
+                self.alt_labels.append(current_freq_string)
+
+        # Customize Plot
+        if self.polar:
+            if mhz:
+                self.sc.ax.set_xlabel('Frequency (MHz)')
+            else:
+                self.sc.ax.set_xlabel('Frequency (GHz)')
+            self.sc.ax.set_rlabel_position(0)  # r max is 0 dB
+            self.sc.ax.set_theta_zero_location("N")  # 0 degrees at 12 o'clock
+            self.sc.ax.set_theta_direction(-1)  # Degrees increase clockwise
+            self.sc.ax.set_rmax(0)  # Lines are empty, so r max can not be found from the data
+            self.sc.ax.set_rmin(-40)  # r min is -40 dB
+            self.sc.ax.grid(True)
+            self.sc.ax.set_thetagrids(range(0, 360, 15))  # Ticks increase every 15 degrees
+            self.sc.figure.subplots_adjust(left=0.05,
+                                           right=0.80)
+        else:
+            self.sc.ax.grid(True)
+            self.sc.ax.set_xlim(left=-180,  # x min -180, x max 180
+                                right=180)
+            self.sc.ax.set_ylim(top=0,  # y min 0 dB, y max -40 dB
+                                bottom=-40)
+            self.sc.ax.set_xlabel('Degrees')
+            self.sc.ax.set_ylabel('S21 Amplitude (dB)')
+            self.sc.ax.set_xticks(range(-180, 180, 30))  # Ticks increase every 30 degrees
+            self.sc.figure.subplots_adjust(left=0.05,
+                                           right=0.95)
+        self.sc.figure.suptitle('Normalized Far-field Pattern',
+                                fontweight="bold",
+                                fontsize=15)
+
+        # Create subplot to house the legend
+        if self.polar:
+            self.sc.bx = self.sc.figure.add_subplot(1, 64, (1, 9))
+            ncol = 1
+        else:
+            self.sc.bx = self.sc.figure.add_subplot(64, 1, (57, 64))
+            if mhz:
+                self.sc.bx.set_xlabel('Frequency (MHz)')
+            else:
+                self.sc.bx.set_xlabel('Frequency (GHz)')
+            ncol = 10
+        self.sc.bx.spines["top"].set_visible(False)
+        self.sc.bx.spines["bottom"].set_visible(False)
+        self.sc.bx.spines["right"].set_visible(False)
+        self.sc.bx.spines["left"].set_visible(False)
+        self.plot_lines, self.plot_labels = self.sc.ax.get_legend_handles_labels()
+
+        # Create buttons (On/Off)
+        self.radio = MyRadioButtons(self.sc.bx, self.alt_labels,
+                                    marker='D',  # String chosen from matplotlib markers
+                                    keep_color=self.live,  # Bool whether button pushes have changing color effect
+                                    size=100,  # If diamond type_of_marker size=100
+                                    ncol=ncol)
+
+    def refresh_impedance(self):
+        """
+        This method updates the impedance lines from the S11 rows read so far
+        :return: None
+        """
+        if len(self.source.s11_series()[0]) == 0:
+            return
+        if not self.live_lines:
+            self.create_impedance_plot()
+        self.update_impedance_lines()
+        self.sc.draw()
+
+    def update_impedance_lines(self):
+        """
+        This method sets the data of the impedance lines from the LiveDataSource
+        S11 rows are few, so the axes are rescaled to the data on every update
+        :return: None
+        """
+        freq_val_set, magnitude, phase = self.source.s11_series()
+        if not self.mhz_or_ghz():
+            freq_val_set = freq_val_set / 1000
+        impedance_real_set, impedance_imag_set = self.impedance(magnitude, phase)
+        self.live_lines[0].set_data(freq_val_set, impedance_real_set)
+        self.live_lines[1].set_data(freq_val_set, impedance_imag_set)
+        self.sc.ax.relim()
+        self.sc.ax.autoscale_view()
+
+    def create_impedance_plot(self):
+        """
+        This method creates the axes, lines and legend of the S11 plot fed from the
+        LiveDataSource
+        Rectangular plot - Frequency vs. Impedance
+        :return: None
+        """
+        self.sc.figure.clf()
+        self.background = None
+        self.max_freq = np.unique(self.source.s11_series()[0])[:10][-1]
+        mhz = self.mhz_or_ghz()  # Determines if lines should be represented in MHz or GHz
+        self.alt_labels = []
+
+        # Create subplot for graph window
+        self.sc.ax = self.sc.figure.add_subplot(64, 1, (1, 50))
+
+        # Add empty real and imaginary lines to subplot
+        line, = self.sc.ax.plot([], [],
+                                marker=".",
+                                markersize=10,
+                                label="Real Z",
+                                color='C0')
+        self.live_lines = [line]
+        self.alt_labels.append("Real Z")
+        line, = self.sc.ax.plot([], [], '--',
+                                marker=".",
+                                markersize=10,
+                                label="Imag Z",
+                                color='C' + str(1 % 10))
+        self.live_lines.append(line)
+        self.alt_labels.append("Imag Z")
+
+        # Customize Plot
+        self.sc.ax.grid(True)
+        if mhz:
+            self.sc.ax.set_xlabel('Frequency (MHz)')
+        else:
+            self.sc.ax.set_xlabel('Frequency (GHz)')
+        self.sc.ax.set_ylabel('Impedance (Ohms)')
+
+        self.sc.figure.subplots_adjust(left=0.05,
+                                       right=0.95)
+        self.sc.figure.suptitle('Impedance',
+                                fontweight="bold",
+                                fontsize=15)
+
+        # Create subplot to house the legend
+        self.sc.bx = self.sc.figure.add_subplot(64, 1, (57, 64))
+        self.sc.bx.spines["top"].set_visible(False)
+        self.sc.bx.spines["bottom"].set_visible(False)
+        self.sc.bx.spines["right"].set_visible(False)
+        self.sc.bx.spines["left"].set_visible(False)
+        self.plot_lines, self.plot_labels = self.sc.ax.get_legend_handles_labels()
+
+        # Create buttons (On/Off)
+        self.radio = MyRadioButtons(self.sc.bx, self.alt_labels,
+                                    marker='D',  # String chosen from matplotlib markers
+                                    keep_color=self.live,  # Bool whether button pushes have changing color effect
+                                    size=100,  # If diamond type_of_marker size=100
+                                    ncol=10)
+
+    @staticmethod
+    def impedance(magnitude, phase):
+        """
+        This function converts S11 measurements to impedance
+        :param magnitude: Array of S11 magnitudes in dB
+        :param phase: Array of S11 phases in degrees
+        :return: Tuple of real and imaginary impedance arrays in Ohms
+        """
+        r_set = 10 ** (magnitude / 20)
+        phase_radians = np.radians(phase)
+        denominator = 1 + r_set * r_set - 2 * r_set * np.cos(phase_radians)
+        impedance_real_set = (50 * (1 - r_set * r_set)) / denominator
+        impedance_imag_set = (2 * r_set * np.sin(phase_radians) * 50) / denominator
+        return impedance_real_set, impedance_imag_set
+
+    def check_source_s11(self):
+        """
+        This method sends whether S11 measurements were read from the LiveDataSource back to the GUI
+        :return: Bool: if True the LiveDataSource contains S11 measurements
+        """
+        if len(self.source.s11_series()[0]) > 0:
+            self.signals.s11_present.emit()
+            return True
+        self.signals.s11_absent.emit()
+        return False
+
+    def plot_source(self):
+        """
+        This method graphs the rows read by the LiveDataSource from its per-frequency
+        arrays, instead of building a DataFrame of the whole file
+        :return: None
+        """
+        self.source.poll()
+        self.live_lines = []
+        s11_present = self.check_source_s11()
+        if self.s11 and s11_present:
+            self.create_impedance_plot()
+            self.update_impedance_lines()
+        elif self.source.s21:
+            self.create_live_plot()
+            self.update_live_lines()
+        else:
+            return
+        # If not updating in real time lines can be turned on and off
+        if not self.live:
+            self.sc.figure.canvas.mpl_connect('pick_event', self.set_visible)
+        self.sc.draw()
+
+    @staticmethod
+    def freq_string(freq, mhz):
+        """
+        This function creates the legend string of a frequency
+        :param freq: Frequency in MHz
+        :param mhz: Bool True if the legend is in MHz else GHz
+        :return: String of the frequency
+        """
+        if mhz:
+            return str(float(freq))
+        if freq < 1:
+            return str(round(freq / 1000, 5))
+        return str(float(freq / 1000))
+
     def set_visible(self, label):
         """
         This method will show and hide lines on the graph
@@ -504,8 +836,12 @@ class DataProcessing(QtWidgets.QMainWindow):
     def read_file(self):
         """
         This method reads a file into a Pandas DataFrame
+        Binary files are memory mapped, so their columns are not parsed or copied
         :return: If not empty returns DataFrame
         """
+        if data_storage.is_binary(self.data_file):
+            records = data_storage.read_binary(self.data_file)[1]
+            return pd.DataFrame(data_storage.to_columns(records))
         df = pd.read_csv(self.data_file)
         return df
 
@@ -514,6 +850,11 @@ class DataProcessing(QtWidgets.QMainWindow):
         This function looks for 'null' at the end of data frame
         :return: Bool True if null not found else False
         """
+        if self.source is not None:
+            self.source.poll()
+            return not self.source.complete
+        if data_storage.is_binary(self.data_file):
+            return not data_storage.is_complete(self.data_file)
         with open(self.data_file, 'r') as f:
             lines = f.read().splitlines()
             last_line = lines[-1]
@@ -659,6 +1000,10 @@ class DataProcessing(QtWidgets.QMainWindow):
         if is_empty:
             print('File is empty')
             return
+        if self.source is not None:
+            # Only the rows appended since the last refresh are parsed
+            self.plot_source()
+            return
         df = self.read_file()
         if df.empty:
             # print('File only contains column headers')
@@ -0,0 +1,204 @@
+###################################################################################
+#  Live Source
+#
+#  Description:     Live Source keeps the measurements of a data file in memory
+#                   while Measurement Control is still appending to it. The file
+#                   is never re-read from the start: the byte offset (or record
+#                   count for binary files) reached by the previous refresh is
+#                   remembered, and only the rows appended since then are parsed.
+#                   Parsed rows are appended to growable numpy arrays, per
+#                   frequency for S21 and in file order for S11, that plots are
+#                   fed from directly, so the cost of a refresh depends on the
+#                   amount of new data, not on the size of the file.
+#
+#  Dependencies:    Pandas Version: 1.1.4
+#                   Numpy Version: 1.19.3
+#
+#  Built with Python Version: 3.8.5
+###################################################################################
+
+import io
+import os
+from threading import Lock
+import numpy as np
+import pandas as pd
+import measurement_ctrl.data_storage as data_storage
+
+COLUMNS = ['measurement_type', 'freq', 'theta', 'phi', 'magnitude', 'phase']
+S11 = data_storage.TYPE_CODES['S11']
+S21 = data_storage.TYPE_CODES['S21']
+
+
+class GrowableColumn:
+    """Numpy array that can be appended to in amortized constant time"""
+
+    def __init__(self, dtype=np.float64, capacity=1024):
+        self.data = np.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def append(self, values):
+        """
+        Appends an array of values to the end of the column
+        :param values: Array of values to append
+        :return: None
+        """
+        end = self.size + len(values)
+        if end > len(self.data):
+            grown = np.empty(max(end, 2 * len(self.data)), dtype=self.data.dtype)
+            grown[:self.size] = self.data[:self.size]
+            self.data = grown
+        self.data[self.size:end] = values
+        self.size = end
+
+    def view(self):
+        """
+        :return: Array holding the values appended so far (not a copy)
+        """
+        return self.data[:self.size]
+
+
+class LiveDataSource:
+
+    def __init__(self, data_file):
+        self.data_file = data_file  # File containing data recorded from measurement control
+        self.file = None  # Handle of data_file, kept open between refreshes
+        self.offset = 0  # Byte offset in data_file up to which rows were parsed
+        self.partial = b''  # Incomplete last line of a csv file, parsed on a later refresh
+        self.complete = False  # Bool True once the end of measurement marker was read
+        self.s21 = {}  # Frequency -> (phi column, magnitude column) of S21 measurements
+        self.s11 = (GrowableColumn(), GrowableColumn(), GrowableColumn())  # Freq, magnitude, phase of S11
+        self.max_magnitude = -np.inf  # Largest S21 magnitude read so far
+        self.lock = Lock()  # Refreshes may be requested from more than one worker thread
+
+    def poll(self):
+        """
+        This method parses the rows appended to the data file since the last call
+        :return: Number of new rows
+        """
+        with self.lock:
+            if data_storage.is_binary(self.data_file):
+                columns = self.read_new_records()
+            else:
+                columns = self.read_new_lines()
+            if columns is None:
+                return 0
+            self.append(columns)
+            return len(columns['freq'])
+
+    def close(self):
+        """
+        This method closes the data file handle; a later poll opens it again
+        :return: None
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def open(self):
+        """
+        :return: Handle of the data file, opened on the first call
+        """
+        if self.file is None:
+            self.file = open(self.data_file, 'rb')
+        return self.file
+
+    def read_new_lines(self):
+        """
+        This method parses the complete csv lines appended since the last call
+        :return: Dictionary of new columns, or None if there are none
+        """
+        f = self.open()
+        f.seek(self.offset)
+        chunk = f.read()
+        if not chunk:
+            return None
+        self.offset += len(chunk)
+        chunk = self.partial + chunk
+        end = chunk.rfind(b'\n') + 1
+        self.partial = chunk[end:]
+        chunk = chunk[:end]
+        if chunk.startswith(b'measurement_type'):
+            chunk = chunk[chunk.find(b'\n') + 1:]
+        if not chunk:
+            return None
+        df = pd.read_csv(io.BytesIO(chunk), header=None, names=COLUMNS)
+        types = np.zeros(len(df.index), dtype=np.int32)
+        types[(df['measurement_type'] == 'S11').values] = S11
+        types[(df['measurement_type'] == 'S21').values] = S21
+        columns = {name: df[name].values.astype(np.float64) for name in COLUMNS[1:]}
+        columns['measurement_type'] = types
+        return columns
+
+    def read_new_records(self):
+        """
+        This method maps the binary records appended since the last call
+        :return: Dictionary of new columns, or None if there are none
+        """
+        if self.offset == 0:
+            self.offset = data_storage.read_header(self.data_file)[1]
+        f = self.open()
+        # Only whole records; one that is still being written is read on a later refresh
+        count = (os.fstat(f.fileno()).st_size - self.offset) // data_storage.RECORD.itemsize
+        if count <= 0:
+            return None
+        f.seek(self.offset)
+        records = np.fromfile(f, dtype=data_storage.RECORD, count=count)
+        self.offset += len(records) * data_storage.RECORD.itemsize
+        return {name: records[name] for name in COLUMNS}
+
+    def append(self, columns):
+        """
+        This method adds new rows to the S21 and S11 arrays
+        :param columns: Dictionary of new columns
+        :return: None
+        """
+        types = columns['measurement_type']
+        end = np.flatnonzero(types == data_storage.END_CODE)
+        if len(end) > 0:
+            # Rows after the end of measurement marker are not part of the data
+            self.complete = True
+            columns = {name: values[:end[0]] for name, values in columns.items()}
+            types = columns['measurement_type']
+
+        s11 = types == S11
+        if s11.any():
+            self.s11[0].append(columns['freq'][s11])
+            self.s11[1].append(columns['magnitude'][s11])
+            self.s11[2].append(columns['phase'][s11])
+
+        s21 = types == S21
+        if not s21.any():
+            return
+        freq = columns['freq'][s21]
+        phi = columns['phi'][s21]
+        magnitude = columns['magnitude'][s21]
+        self.max_magnitude = max(self.max_magnitude, magnitude.max())
+        for f in np.unique(freq):
+            rows = freq == f
+            if f not in self.s21:
+                self.s21[f] = (GrowableColumn(), GrowableColumn())
+            self.s21[f][0].append(phi[rows])
+            self.s21[f][1].append(magnitude[rows])
+
+    def frequencies(self):
+        """
+        :return: Sorted list of the S21 frequencies read so far
+        """
+        return sorted(self.s21.keys())
+
+    def s21_series(self, freq):
+        """
+        :param freq: Frequency of the series
+        :return: Tuple of phi and magnitude arrays, sorted by phi
+        """
+        phi = self.s21[freq][0].view()
+        magnitude = self.s21[freq][1].view()
+        order = np.argsort(phi, kind='stable')
+        return phi[order], magnitude[order]
+
+    def s11_series(self):
+        """
+        :return: Tuple of freq, magnitude and phase arrays of the S11 measurements, in file order
+        """
+        return self.s11[0].view(), self.s11[1].view(), self.s11[2].view()
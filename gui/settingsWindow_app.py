@@ -136,7 +136,8 @@ class SettingsWindow(baseUIWidget, baseUIClass):
             "resolution": None,
             "gpib_addr": None,
             "alias": None,
-            "baud_rate": None
+            "baud_rate": None,
+            "storage_format": "csv"
         }
         
         if len(self.lineEdit_stop_4.text()) > 0 and len(self.lineEdit_start_4.text()) > 0:
@@ -167,6 +168,8 @@ class SettingsWindow(baseUIWidget, baseUIClass):
         settings_dict["fixed_angle"] = self.sweep_elevation_spinBox.value()
         settings_dict["resolution"] = self.res_doubleSpinBox_7.value()
         settings_dict["gpib_addr"] = int(self.GPIB_addr_comboBox_6.currentText())
+        if self.data_format_comboBox_6.currentText() == 'Binary':
+            settings_dict["storage_format"] = "binary"
         with open(self.pivot_file, "w") as file:
             dump(settings_dict, file)
         self.settings_empty = False
@@ -243,6 +243,14 @@ class Ui_Form(object):
         self.open_data_Button = QtWidgets.QPushButton(self.main_tab_4)
         self.open_data_Button.setObjectName("open_data_Button")
         self.hardware_settings_gridLayout_6.addWidget(self.open_data_Button, 3, 1, 1, 1)
+        self.data_format_label_6 = QtWidgets.QLabel(self.main_tab_4)
+        self.data_format_label_6.setObjectName("data_format_label_6")
+        self.hardware_settings_gridLayout_6.addWidget(self.data_format_label_6, 4, 0, 1, 1)
+        self.data_format_comboBox_6 = QtWidgets.QComboBox(self.main_tab_4)
+        self.data_format_comboBox_6.setObjectName("data_format_comboBox_6")
+        self.data_format_comboBox_6.addItem("")
+        self.data_format_comboBox_6.addItem("")
+        self.hardware_settings_gridLayout_6.addWidget(self.data_format_comboBox_6, 4, 1, 1, 1)
         self.verticalLayout_6.addLayout(self.hardware_settings_gridLayout_6)
         self.settingsTabs.addTab(self.main_tab_4, "")
         self.positioner_tab_4 = QtWidgets.QWidget()
@@ -452,6 +460,9 @@ class Ui_Form(object):
         self.label.setText(_translate("Form", "Project Directory:"))
         self.dir_Button.setText(_translate("Form", "Select"))
         self.open_data_Button.setText(_translate("Form", "Open Previous Measurement"))
+        self.data_format_label_6.setText(_translate("Form", "Data Format : "))
+        self.data_format_comboBox_6.setItemText(0, _translate("Form", "CSV"))
+        self.data_format_comboBox_6.setItemText(1, _translate("Form", "Binary"))
         self.settingsTabs.setTabText(self.settingsTabs.indexOf(self.main_tab_4), _translate("Form", "Main Settings"))
         self.up_toolButton_4.setText(_translate("Form", "+ EL"))
         self.up_toolButton_4.setShortcut(_translate("Form", "W"))
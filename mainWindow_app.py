@@ -14,8 +14,9 @@ from gui.settingsWindow_app import SettingsWindow
 from gui.progress_bar_app import ProgressBar
 from gui.graph_mode_toolbar_app import GraphModeToolBar
 from data_processing.data_processing import DataProcessing, Worker
+from data_processing.live_source import LiveDataSource
 from measurement_ctrl.measurement_ctrl import MeasurementCtrl
-from measurement_ctrl.data_storage import create_file
+from measurement_ctrl.data_storage import create_file, BINARY_EXTENSION
 import json
 from time import sleep
 from threading import Lock, Thread
@@ -127,6 +128,7 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
         self.qpt_thread = None  # Placeholder for qpt_controller thread
 
         self.data_file = None
+        self.live_source = None  # Rows of data_file already read, kept between plot refreshes
 
         # --------------------------------------------------------------------------
 
@@ -230,17 +232,20 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
                 # MeasurementCtrl object
                 with open(self.settings.pivot_file) as file:
                     dict = json.load(file)
-                self.data_file = '/' + strftime("%b%d_%H%M_%S", localtime()) + '.csv'
+                if dict.get('storage_format') == 'binary':
+                    self.data_file = '/' + strftime("%b%d_%H%M_%S", localtime()) + BINARY_EXTENSION
+                else:
+                    self.data_file = '/' + strftime("%b%d_%H%M_%S", localtime()) + '.csv'
                 self.data_file = self.settings.project_dir + self.data_file
                 try:
-                    self.mc = MeasurementCtrl(dict, self.data_file)
+                    self.mc = MeasurementCtrl(dict, self.data_file, telemetry=self.qpt_thread.telemetry)
                 except visa.errors.VisaIOError:
                     msg.setDetailedText(
                         'Need to connect the VNA and configure the GPIB address before the measurement can begin'
                     )
                     msg.exec_()
                 else:
-                    create_file(self.data_file)
+                    create_file(self.data_file, dict)
                     # Connect signals and slots between MeasurementCtrl object,
                     # transport model handlers, positioner queue, and gui
                     self.mc.signals.progress.connect(self.progress_bar.progressBar.setValue)
@@ -259,6 +264,9 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
                     self.transport.stopButton.setEnabled(True)
                     self.qpt_thread.signals.fPan.connect(self.mc.update_pan)
                     self.qpt_thread.signals.fTilt.connect(self.mc.update_tilt)
+                    self.qpt_thread.signals.moving.connect(self.mc.update_moving)
+                    self.qpt_thread.signals.settled.connect(self.mc.update_settled)
+                    self.mc.signals.waiting.connect(self.qpt_thread.set_waiting)
                     # Update the state of MeasurementCtrl, then create and start
                     # thread for MeasurementCtrl.run() to run in
                     self.mc_state = 'SetupRunning'
@@ -651,7 +659,7 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
     def open_prev_measurement(self):
         # noinspection PyCallByClass
         filename = qtw.QFileDialog.getOpenFileName(self, 'Open Previous Measurement Data',
-                                                   'C:/', "CSV File (*.csv)")[0]
+                                                   'C:/', "Measurement Data (*.csv *" + BINARY_EXTENSION + ")")[0]
         if len(filename) > 0:
             self.data_file = filename
             self.update_plot()
@@ -666,6 +674,12 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
         else:
             self.is_live = False
 
+        if self.data_file is not None and \
+                (self.live_source is None or self.live_source.data_file != self.data_file):
+            if self.live_source is not None:
+                self.live_source.close()
+            self.live_source = LiveDataSource(self.data_file)
+
         if self.data_file is not None:
             if self.graph_mode.polar_rect_comboBox.currentText() == 'Polar':
                 if self.graph_mode.s21_imp_comboBox.currentText() == 'S21':
@@ -710,6 +724,11 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
     def live_plotting(self):
         if self.mc_state == 'NotRunning':
             self.worker_timer = None
+        elif self.is_live is True and \
+                self.data_processing.is_live_plot(self.data_file, self.polar, self.s11):
+            # Same plot as the last refresh, so keep the canvas and only update its lines
+            self.data_processing.refresh_live()
+            return
         self.data_processing_toolbar.clear()
         del self.data_processing
         self.data_processing = DataProcessing()
@@ -722,9 +741,14 @@ class MyMainWindow(qtw.QMainWindow, Ui_MainWindow):
         self.data_processing.setFixedHeight(self.height() - 160)
         self.data_processing.setFixedWidth(self.width())
         self.data_processing_toolbar.show()
+        if self.is_live is True and self.mc_state != 'NotRunning':
+            # Matplotlib drawing has to happen on the gui thread, and a live
+            # refresh only changes the data of existing lines, so no worker is used
+            self.data_processing.begin_live(self.data_file, self.polar, self.live_source, self.s11)
+            return
         self.worker = Worker(self.data_processing.begin_measurement,
                              data_file=self.data_file, polar=self.polar, s11=self.s11,
-                             is_live=self.is_live)
+                             is_live=self.is_live, source=self.live_source)
         self.threadpool.start(self.worker)
     # ------------------------------------------------------------------------------
 
@@ -0,0 +1,231 @@
+################################################################################
+# codec
+# Description:
+#   Table driven encoder/decoder for PTHR-90 frames. Escaping, unescaping,
+#   LRC checksums and framing are each done in a single pass over the packet
+#   using tables computed once at import, instead of building the output one
+#   byte at a time. The output is byte-identical to the original functions
+#   in packet.py, which now call into this module.
+#
+#   Running this module checks the codec against the original implementations
+#   and prints a micro-benchmark of both:
+#       python -m measurement_ctrl.codec
+#
+# Status: Complete
+# Dependencies: None
+#
+# Built with Python Version: 3.8.5
+################################################################################
+import re
+from measurement_ctrl.constants import CTRL, ESC, ESC_MASK
+
+
+STX = CTRL['STX']
+ETX = CTRL['ETX']
+
+# Bytes that must be escaped: the control chars and ESC itself
+SPECIAL = frozenset(c[0] for c in CTRL.values()) | {ESC[0]}
+
+# ESCAPE[b] is what byte b becomes in a transmitted packet
+ESCAPE = tuple(
+    ESC + bytes([b | ESC_MASK]) if b in SPECIAL else bytes([b])
+    for b in range(256)
+)
+
+# BYTE[b] is b as a single byte
+BYTE = tuple(bytes([b]) for b in range(256))
+
+# UNESCAPE[b] is the byte restored from ESC followed by b
+UNESCAPE = tuple(bytes([b & ~ESC_MASK & 0xff]) for b in range(256))
+
+_SPECIAL_PATTERN = re.compile(b'[' + b''.join(re.escape(bytes([b])) for b in sorted(SPECIAL)) + b']')
+_ESCAPED_PATTERN = re.compile(re.escape(ESC) + b'(.)', re.DOTALL)
+
+
+def lrc(data):
+    """Returns the LRC checksum (XOR of every byte) of data as an int. Packets are
+    at most a dozen bytes, where a plain loop beats reduce() or int folding"""
+    checksum = 0
+    for b in data:
+        checksum ^= b
+    return checksum
+
+
+def generate_LRC(data):
+    """Returns the LRC checksum of data as a single byte"""
+    return BYTE[lrc(data)]
+
+
+def valid_LRC(data):
+    """True if data, ending with its LRC, XORs to zero"""
+    return lrc(data) == 0
+
+
+def escape(data):
+    """Escapes every control char or ESC in data: ESC, then the byte with bit 7 set"""
+    if _SPECIAL_PATTERN.search(data) is None:
+        return bytes(data)
+    return b''.join(map(ESCAPE.__getitem__, data))
+
+
+def unescape(data):
+    """Removes each ESC and clears bit 7 of the byte following it"""
+    if ESC not in data:
+        return bytes(data)
+    return _ESCAPED_PATTERN.sub(lambda m: UNESCAPE[m.group(1)[0]], data)
+
+
+def frame(data):
+    """Builds a transmittable frame from the command byte and packet data:
+    STX, escaped data and LRC, ETX"""
+    data = bytes(data)
+    return STX + escape(data + BYTE[lrc(data)]) + ETX
+
+
+def payload(frame):
+    """Returns the unescaped command, data and LRC of a frame, without STX and ETX"""
+    return unescape(frame[1:-1])
+
+
+def validate(frame):
+    """Returns the unescaped payload of a frame if its LRC is valid, else None"""
+    data = payload(frame)
+    if len(data) < 2 or lrc(data) != 0:
+        return None
+    return data
+
+
+class FrameDecoder:
+    """Incremental decoder for the bytes received from the positioner. Bytes are
+    kept in a persistent buffer between calls to feed(), so frames split across
+    reads are joined, and bytes before an STX are skipped. A raw ETX always ends
+    a frame because an ETX inside a frame is escaped; an STX before the ETX means
+    the frame was truncated, and decoding resyncs on the new STX."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.dropped = 0  # Bytes skipped while resyncing
+        self.invalid = 0  # Complete frames discarded for a bad LRC
+
+    def clear(self):
+        self.buffer.clear()
+
+    def feed(self, data):
+        """Adds received bytes, returning the list of complete frames with a valid
+        LRC, each from STX to ETX as received (still escaped)"""
+        self.buffer += data
+        frames = []
+        buffer = self.buffer
+        while True:
+            start = buffer.find(STX)
+            if start < 0:
+                self.dropped += len(buffer)
+                buffer.clear()
+                break
+            if start > 0:
+                self.dropped += start
+                del buffer[:start]
+            end = buffer.find(ETX, 1)
+            if end < 0:
+                break
+            restart = buffer.find(STX, 1, end)
+            if restart > 0:
+                self.dropped += restart
+                del buffer[:restart]
+                continue
+            frame = bytes(buffer[:end + 1])
+            del buffer[:end + 1]
+            if validate(frame) is None:
+                self.invalid += 1
+            else:
+                frames.append(frame)
+        return frames
+"""End FrameDecoder Class"""
+
+
+if __name__ == '__main__':
+    import random
+    import timeit
+    import measurement_ctrl.packet as pkt
+    from measurement_ctrl.integer import Coordinate
+
+    # The original implementations from packet.py, used as the reference
+    ctrl_chars = CTRL.values()
+
+    def legacy_generate_LRC(data):
+        checksum = 0
+        for item in data:
+            checksum = checksum ^ item
+        return (checksum).to_bytes(1, byteorder='little')
+
+    def legacy_insert_esc(data):
+        tx_packet = bytes()
+        for item in data:
+            val = item.to_bytes(1, byteorder='little')
+            if val in ctrl_chars or val == ESC:
+                tx_packet += b'\x1b'
+                tx_packet += (item | ESC_MASK).to_bytes(1, byteorder='little')
+            else:
+                tx_packet += val
+        return tx_packet
+
+    def legacy_strip_esc(data):
+        rx = list(data)
+        rx_packet = bytes()
+        include_next = False
+        for i in range(len(rx)):
+            val = rx[i].to_bytes(1, byteorder='little')
+            if val != ESC or include_next is True:
+                rx_packet += val
+                include_next = False
+            else:
+                rx[i+1] = (rx[i+1] & (~ESC_MASK))
+                include_next = True
+        return rx_packet
+
+    def legacy_frame(data):
+        return bytes(b'\x02' + legacy_insert_esc(data + legacy_generate_LRC(data)) + b'\x03')
+
+    # Check every single byte, random packets, and the packets the software sends
+    rng = random.Random(0)
+    samples = [bytes([b]) for b in range(256)]
+    samples += [bytes(rng.randrange(256) for _ in range(rng.randrange(1, 16))) for _ in range(20000)]
+    samples += [bytes(rng.choice(sorted(SPECIAL)) for _ in range(8)) for _ in range(1000)]
+    for data in samples:
+        assert generate_LRC(data) == legacy_generate_LRC(data)
+        assert escape(data) == legacy_insert_esc(data)
+        assert frame(data) == legacy_frame(data)
+        escaped = legacy_insert_esc(data)
+        assert unescape(escaped) == legacy_strip_esc(escaped) == data
+        assert validate(legacy_frame(data)) == data + legacy_generate_LRC(data)
+    packets = [pkt.get_status(), pkt.stop(), pkt.fault_reset(),
+               pkt.jog_positioner(127, 1, 0, 0), pkt.jog_positioner(8, 0, 17, 1),
+               pkt.move_to_entered_coords(Coordinate(-180, 0)),
+               pkt.move_to_entered_coords(Coordinate(2.58, -0.03)),
+               pkt.set_minimum_speeds(8, 17), pkt.set_minimum_speeds(50, 50)]
+    for packet in packets:
+        assert unescape(packet) == legacy_strip_esc(packet)
+        assert frame(unescape(packet)[1:-2]) == packet
+    print('codec output matches the original implementation on {} samples'.format(len(samples) + len(packets)))
+
+    # Frames split at every position, with garbage, a truncated frame and a bad LRC mixed in
+    stream = b'\x00\x99' + packets[1] + b'\x02\x31\x00' + packets[3] + packets[5][:-2] + b'\x55\x03' + packets[7]
+    for split in range(len(stream)):
+        decoder = FrameDecoder()
+        frames = decoder.feed(stream[:split]) + decoder.feed(stream[split:])
+        assert frames == [packets[1], packets[3], packets[7]], split
+    print('FrameDecoder resyncs and reassembles frames split at any of {} positions'.format(len(stream)))
+
+    # Typical traffic: a status reply, and a jog that needs escaping
+    status = unescape(b'\x02\x31\x00\xb9\x00\x00\x00\x00\x80\x08\x03')[1:-1]
+    jog = bytes(b'\x31\x00\x01\x00\x00\x00')
+    number = 100000
+    for name, new, old, arg in [
+            ('generate_LRC', generate_LRC, legacy_generate_LRC, status),
+            ('insert_esc', escape, legacy_insert_esc, jog + generate_LRC(jog)),
+            ('strip_esc', unescape, legacy_strip_esc, frame(jog)),
+            ('frame', frame, legacy_frame, jog)]:
+        t_new = timeit.timeit(lambda: new(arg), number=number)
+        t_old = timeit.timeit(lambda: old(arg), number=number)
+        print('{:<13} original {:6.3f} us  codec {:6.3f} us  ({:4.1f}x)'.format(
+            name, t_old / number * 1e6, t_new / number * 1e6, t_old / t_new))
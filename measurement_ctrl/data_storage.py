@@ -2,28 +2,277 @@
 #  data_storage
 #
 #  Description: Contains functions used to store the data collected from the
-#               positioner and VNA into a csv file.
-#  Dependencies: None
+#               positioner and VNA into a csv file, or into a binary file of
+#               fixed size records that can be memory mapped, and to convert
+#               between the two formats.
+#  Dependencies: Numpy Version: 1.19.3
 #
 #  Author(s): Eric Li
 #  Date: 2020/10/17
 #  Built with Python Version: 3.8.5
 ################################################################################
+import os
+import json
+import numpy as np
+
+
+# Binary file layout:
+#   magic (8 bytes) | header length (uint32, little endian) | JSON header | records...
+# The JSON header is padded with spaces so the records start on a 64 byte
+# boundary. Each record holds one row of the csv layout, with the measurement
+# type stored as an integer code. A record with code 0 and NaN values marks a
+# completed measurement, like the row of nulls at the end of the csv file.
+BINARY_EXTENSION = '.awr'
+BINARY_MAGIC = b'AWRTDATA'
+RECORD = np.dtype([
+    ('measurement_type', '<i4'),
+    ('freq',             '<f8'),
+    ('theta',            '<f8'),
+    ('phi',              '<f8'),
+    ('magnitude',        '<f8'),
+    ('phase',            '<f8'),
+], align=True)
+TYPE_CODES = {'S11': 11, 'S21': 21}
+TYPE_NAMES = {11: 'S11', 21: 'S21'}
+END_CODE = 0
+
+
+class DataWriter:
+    """Keeps the csv data file open for the length of a measurement run.
+
+    Each trace is formatted in one bulk operation and handed to the file
+    buffer with a single write. The buffer is flushed to the OS every
+    flush_every traces (1 = after every trace, 0 = only when flush(), sync()
+    or close() is called), and sync()/close() also fsync the file so the
+    data survives a crash of the program or the machine.
+    """
+    _BUFFER_SIZE = 1 << 16
+    _MODE = 'a'
+
+    def __init__(self, filename, flush_every=1):
+        self.filename = filename
+        self.flush_every = flush_every
+        self.file = None
+        self.pending = 0  # number of traces written since the last flush
+
+    def open(self):
+        if self.file is None:
+            self.file = open(self.filename, self._MODE, buffering=self._BUFFER_SIZE)
+        return self.file
+
+    def encode(self, data):
+        return format_rows(data)
+
+    def encode_end(self):
+        return 'null,null,null,null,null,null\n'
+
+    def write(self, data):
+        """Appends a vna_comms.Trace, or a list of vna_comms.Data points"""
+        self.open().write(self.encode(data))
+        self.pending = self.pending + 1
+        if self.flush_every and self.pending >= self.flush_every:
+            self.flush()
+
+    def write_end(self):
+        """Writes the row of nulls marking a completed measurement"""
+        self.open().write(self.encode_end())
+        self.flush()
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+        self.pending = 0
+
+    def sync(self):
+        """Flushes the buffer and forces the data onto the disk"""
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.pending = 0
+
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+"""End DataWriter Class"""
+
+
+class BinaryWriter(DataWriter):
+    """DataWriter for the binary format. Each trace is packed into an array
+    of records and its buffer is written to the file without being copied
+    into an intermediate string."""
+    _MODE = 'ab'
+
+    def encode(self, data):
+        return memoryview(to_records(data))
+
+    def encode_end(self):
+        return memoryview(end_record())
+"""End BinaryWriter Class"""
+
+
+def is_binary(filename):
+    return filename.lower().endswith(BINARY_EXTENSION)
+
+
+def create_writer(filename, flush_every=1):
+    """Returns the writer matching the format of filename"""
+    if is_binary(filename):
+        return BinaryWriter(filename, flush_every)
+    return DataWriter(filename, flush_every)
+
+
+def format_rows(data):
+    """Formats a vna_comms.Trace, or a list of vna_comms.Data points, into csv rows"""
+    if not isinstance(data, list):
+        # Columnar trace: the scalar columns are formatted once and shared by
+        # every row, the per-frequency columns are formatted in one pass
+        if isinstance(data.phi, np.ndarray):
+            row = '%s,%%f,%f,%%f,%%f,%%f\n' % (data.measurement_type, data.theta)
+            return ''.join(map(row.__mod__, zip(data.freq.tolist(),
+                                                data.phi.tolist(),
+                                                data.value_mag.tolist(),
+                                                data.value_phase.tolist())))
+        row = '%s,%%f,%f,%f,%%f,%%f\n' % (data.measurement_type, data.theta, data.phi)
+        return ''.join(map(row.__mod__, zip(data.freq.tolist(),
+                                            data.value_mag.tolist(),
+                                            data.value_phase.tolist())))
+    return ''.join(['%s,%f,%f,%f,%f,%f\n' % (
+        point.measurement_type,
+        point.freq,
+        point.theta,
+        point.phi,
+        point.value_mag,
+        point.value_phase) for point in data])
+
+
+def to_records(data):
+    """Packs a vna_comms.Trace, or a list of vna_comms.Data points, into binary records"""
+    if isinstance(data, list):
+        records = np.zeros(len(data), dtype=RECORD)
+        for i, point in enumerate(data):
+            records[i] = (TYPE_CODES[point.measurement_type], point.freq, point.theta,
+                          point.phi, point.value_mag, point.value_phase)
+        return records
+    records = np.zeros(len(data.freq), dtype=RECORD)
+    records['measurement_type'] = TYPE_CODES[data.measurement_type]
+    records['freq'] = data.freq
+    records['theta'] = data.theta
+    records['phi'] = data.phi
+    records['magnitude'] = data.value_mag
+    records['phase'] = data.value_phase
+    return records
+
+
+def end_record():
+    record = np.zeros(1, dtype=RECORD)
+    record['measurement_type'] = END_CODE
+    for name in RECORD.names[1:]:
+        record[name] = np.nan
+    return record
+
 
 def append_data(filename, data):
-    file = open(filename, 'a')
-    for i in range(0, len(data)):
-        file.write('%s,%f,%f,%f,%f,%f\n' % (
-            data[i].measurement_type, 
-            data[i].freq, 
-            data[i].theta, 
-            data[i].phi, 
-            data[i].value_mag, 
-            data[i].value_phase))
-    file.close()
+    """Appends a vna_comms.Trace, or a list of vna_comms.Data points, to filename"""
+    writer = create_writer(filename)
+    writer.write(data)
+    writer.close()
 
 
-def create_file(filename):
+def create_file(filename, settings=None):
+    """Creates an empty data file. Binary files store settings (the contents of
+    pivot.json) in their header."""
+    if is_binary(filename):
+        with open(filename, 'wb') as file:
+            file.write(binary_header(settings))
+        return
     file = open(filename, 'w')
     file.write('measurement_type,freq,theta,phi,magnitude,phase\n')
     file.close()
+
+
+def binary_header(settings=None):
+    header = json.dumps({
+        'version': 1,
+        'columns': RECORD.names,
+        'record': RECORD.descr,
+        'settings': settings,
+    }).encode()
+    # Pad the header so the records are aligned for memory mapping
+    length = len(BINARY_MAGIC) + 4 + len(header)
+    header = header + b' ' * (-length % 64)
+    return BINARY_MAGIC + len(header).to_bytes(4, byteorder='little') + header
+
+
+def read_header(filename):
+    """Returns the JSON header of a binary data file and the offset of its first record"""
+    with open(filename, 'rb') as file:
+        if file.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise Exception('Not a binary measurement file: {}'.format(filename))
+        length = int.from_bytes(file.read(4), byteorder='little')
+        header = json.loads(file.read(length).decode())
+    return header, len(BINARY_MAGIC) + 4 + length
+
+
+def read_binary(filename):
+    """Memory maps the records of a binary data file without copying them.
+    Returns the JSON header and the array of records. A record that is
+    still being written is left out."""
+    header, offset = read_header(filename)
+    count = (os.path.getsize(filename) - offset) // RECORD.itemsize
+    if count == 0:
+        return header, np.empty(0, dtype=RECORD)
+    return header, np.memmap(filename, dtype=RECORD, mode='r', offset=offset, shape=(count,))
+
+
+def to_columns(records):
+    """Returns the records as a dict of columns matching the csv layout, where
+    measurement types are strings and the end marker row is None/NaN"""
+    columns = {name: records[name] for name in RECORD.names}
+    names = np.full(len(records), None, dtype=object)
+    for code, name in TYPE_NAMES.items():
+        names[records['measurement_type'] == code] = name
+    columns['measurement_type'] = names
+    return columns
+
+
+def is_complete(filename):
+    """Returns True if the data file ends with the end of measurement marker"""
+    if is_binary(filename):
+        records = read_binary(filename)[1]
+        return len(records) > 0 and records['measurement_type'][-1] == END_CODE
+    with open(filename, 'rb') as file:
+        file.seek(0, os.SEEK_END)
+        file.seek(max(0, file.tell() - 64))
+        lines = file.read().splitlines()
+    return len(lines) > 0 and lines[-1] == b'null,null,null,null,null,null'
+
+
+def csv_to_binary(csv_file, binary_file, settings=None):
+    """Converts a csv data file into the binary format"""
+    create_file(binary_file, settings)
+    with open(csv_file, 'r') as file:
+        rows = file.read().splitlines()[1:]
+    records = np.zeros(len(rows), dtype=RECORD)
+    for i, row in enumerate(rows):
+        fields = row.split(',')
+        if fields[0] == 'null':
+            records[i] = end_record()[0]
+        else:
+            records[i] = (TYPE_CODES[fields[0]],) + tuple(float(x) for x in fields[1:6])
+    with open(binary_file, 'ab') as file:
+        file.write(memoryview(records))
+
+
+def binary_to_csv(binary_file, csv_file):
+    """Converts a binary data file into the csv format"""
+    records = read_binary(binary_file)[1]
+    rows = ['measurement_type,freq,theta,phi,magnitude,phase\n']
+    for record in records.tolist():
+        if record[0] == END_CODE:
+            rows.append('null,null,null,null,null,null\n')
+        else:
+            rows.append('%s,%f,%f,%f,%f,%f\n' % ((TYPE_NAMES[record[0]],) + record[1:]))
+    with open(csv_file, 'w') as file:
+        file.write(''.join(rows))
@@ -1,12 +1,13 @@
 ################################################################################
 # integer
 # Description: 
-#   This file contains the implementation of two classes that
+#   This file contains the implementation of three classes that
 #   support data types useful for interacting with the QPT Positioner.
 #   First, the Integer class, for representing Ints in the format required
 #   by the QPT. Second, the Coordinate class, which is essentially an
 #   ordered pair for representing a specific combination of azimuth and 
-#   elevation angles of the positioner in degrees.
+#   elevation angles of the positioner in degrees. Third, CoordinateArray,
+#   which converts arrays of positions at once with numpy.
 #
 # Status:
 #   Mostly finished, I do not foresee any major changes being necessary,
@@ -20,6 +21,15 @@
 # Built with Python Version: 3.8.2
 # For any questions, contact Thomas at tomhoover1@gmail.com
 ################################################################################
+import struct
+
+import numpy as np
+
+
+_SINGLE = struct.Struct('<h') # one 16-bit little endian Int, as sent to the QPT
+_PAIR = struct.Struct('<hh') # a (pan, tilt) pair of them
+
+
 class Integer:
     """Integer: a class to represent a integer value that adheres to the
     PTHR-90 Embedded Controller Protocol Rev J (located in qpt/docs).
@@ -100,107 +110,221 @@ class Coordinate:
     """Coordinate: implements an ordered pair value representing a 
     QPT position (pan, tilt), where pan is the QPT's azimuth angle and tilt 
     is the QPT's elevation angle, both in degrees. 
+
+    Coordinates are immutable. The position is stored as the signed
+    centidegree ints the QPT uses, together with the float angles and the
+    4 byte wire format, which are computed once on construction. A
+    Coordinate built from a received packet keeps the received bytes as is.
+
+    Each Coordinate carries its own (pan, tilt) offsets in degrees, which
+    are added to the stored position to give the angles, and shift the
+    allowed range of the angles. with_offsets() returns a copy with new ones.
     """
-    offsets = {
-        'pan'  : 0.0,
-        'tilt' : 0.0,
-    }
-
-    limits = {
-        'MIN_AZ'  : -180.00,
-        'MAX_AZ'  :  180.00,
-        'MIN_EL'  :  -90.00,
-        'MAX_EL'  :   90.00,
-        'MIN_INT' :  -18000,
-        'MAX_INT' :   18000,
-    }
-
-
-    def __init__(self, pan, tilt, fromqpt=False):
-        if fromqpt is True: 
-            self._phi   = pan
-            self._theta = tilt
-            self._valid = True
-        elif    (isinstance(pan,  int) or isinstance(pan , float)) \
-            and (isinstance(tilt, int) or isinstance(tilt, float)) \
-            and pan  <= self.limits['MAX_AZ'] and pan  >= self.limits['MIN_AZ'] \
-            and tilt <= self.limits['MAX_EL'] and tilt >= self.limits['MIN_EL']:
-                self._phi   = int(pan*100 ).to_bytes(2, byteorder='little', signed='True')
-                self._theta = int(tilt*100).to_bytes(2, byteorder='little', signed='True')
-                self._valid = True
+    __slots__ = ('_pan', '_tilt', '_pan_angle', '_tilt_angle', '_bytes', '_offsets', '_valid')
+
+    MIN_AZ  = -180.00
+    MAX_AZ  =  180.00
+    MIN_EL  =  -90.00
+    MAX_EL  =   90.00
+    MIN_INT =  -18000
+    MAX_INT =   18000
+
+
+    def __init__(self, pan, tilt, fromqpt=False, offsets=(0.0, 0.0)):
+        """pan and tilt are angles in degrees, or if fromqpt is True, the
+        2 byte values received from the QPT (or centidegree ints)"""
+        pan_offset, tilt_offset = offsets
+        if fromqpt is True:
+            wire = _wire(pan) + _wire(tilt)
+            pan, tilt = _PAIR.unpack(wire)
+            valid = True
+        elif    isinstance(pan,  (int, float)) and isinstance(tilt, (int, float)) \
+            and pan  <= self.MAX_AZ + pan_offset  and pan  >= self.MIN_AZ + pan_offset \
+            and tilt <= self.MAX_EL + tilt_offset and tilt >= self.MIN_EL + tilt_offset:
+            pan  = round((pan  - pan_offset)  * 100)
+            tilt = round((tilt - tilt_offset) * 100)
+            wire = _PAIR.pack(pan, tilt)
+            valid = True
+        else:
+            pan = tilt = wire = None
+            valid = False
+
+        _set_pan(self, pan)
+        _set_tilt(self, tilt)
+        _set_bytes(self, wire)
+        _set_offsets(self, (pan_offset, tilt_offset))
+        _set_valid(self, valid)
+        if valid:
+            _set_pan_angle(self, pan / 100 + pan_offset)
+            _set_tilt_angle(self, tilt / 100 + tilt_offset)
         else:
-            self._phi   = None
-            self._theta = None
-            self._valid = False     
+            _set_pan_angle(self, None)
+            _set_tilt_angle(self, None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Coordinate is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Coordinate is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Coordinate):
+            return NotImplemented
+        return (self._pan, self._tilt, self._offsets) == (other._pan, other._tilt, other._offsets)
+
+    def __hash__(self):
+        return hash((self._pan, self._tilt, self._offsets))
+
+    def __repr__(self):
+        if self._valid:
+            return 'Coordinate({:.2f}, {:.2f})'.format(self._pan_angle, self._tilt_angle)
+        return 'Coordinate(invalid)'
 
     def is_valid(self):
         return self._valid
 
-    def update_limits(self, pan_offset, tilt_offset):
-        if pan_offset == 0.0:
-            self.limits['MAX_AZ']  =  180.00
-            self.limits['MIN_AZ']  = -180.00
-            self.limits['MAX_INT'] =  18000
-            self.limits['MIN_INT'] = -18000
-        else:
-            self.limits['MAX_AZ']  = self.limits['MAX_AZ'] + pan_offset
-            self.limits['MIN_AZ']  = self.limits['MIN_AZ'] + pan_offset
-            self.limits['MAX_INT'] = self.limits['MAX_INT'] + pan_offset*100
-            self.limits['MIN_INT'] = self.limits['MIN_INT'] + pan_offset*100
-        if tilt_offset == 0.0:
-            self.limits['MAX_EL'] =  90.00
-            self.limits['MIN_EL'] = -90.00
-        else:
-            self.limits['MAX_EL'] = self.limits['MAX_EL'] + tilt_offset
-            self.limits['MIN_EL'] = self.limits['MIN_EL'] + tilt_offset
+    def with_offsets(self, pan_offset, tilt_offset):
+        """Returns a Coordinate at the same QPT position with new offsets"""
+        if self._valid:
+            return Coordinate(self._pan, self._tilt, fromqpt=True, offsets=(pan_offset, tilt_offset))
+        return Coordinate(None, None, offsets=(pan_offset, tilt_offset))
+
+    def offsets(self):
+        return {'pan': self._offsets[0], 'tilt': self._offsets[1]}
 
-        self.offsets['pan']  = pan_offset
-        self.offsets['tilt'] = tilt_offset
+    def limits(self):
+        pan_offset, tilt_offset = self._offsets
+        return {
+            'MIN_AZ'  : self.MIN_AZ + pan_offset,
+            'MAX_AZ'  : self.MAX_AZ + pan_offset,
+            'MIN_EL'  : self.MIN_EL + tilt_offset,
+            'MAX_EL'  : self.MAX_EL + tilt_offset,
+            'MIN_INT' : self.MIN_INT + pan_offset*100,
+            'MAX_INT' : self.MAX_INT + pan_offset*100,
+        }
 
     def print_limits(self):
-        print('Azimuth limits:  ',  self.limits['MIN_AZ'], ' to ',  self.limits['MAX_AZ'])
-        print('Elevation limits: ', self.limits['MIN_EL'], ' to  ', self.limits['MAX_EL'])
-        print('Integer limits:  ',  self.limits['MIN_INT'], ' to ', self.limits['MAX_INT'])
-        print('Offsets: Pan =',     self.offsets['pan'], ' Tilt =', self.offsets['tilt'])
+        limits = self.limits()
+        print('Azimuth limits:  ',  limits['MIN_AZ'], ' to ',  limits['MAX_AZ'])
+        print('Elevation limits: ', limits['MIN_EL'], ' to  ', limits['MAX_EL'])
+        print('Integer limits:  ',  limits['MIN_INT'], ' to ', limits['MAX_INT'])
+        print('Offsets: Pan =',     self._offsets[0], ' Tilt =', self._offsets[1])
 
     def pan_angle(self):
-        if self._valid:
-            return (int.from_bytes(self._phi, byteorder='little', signed=True) / 100) + self.offsets['pan']
-        return None
+        return self._pan_angle
 
     def tilt_angle(self):
-        if self._valid:
-            return (int.from_bytes(self._theta, byteorder='little', signed=True) / 100) + self.offsets['tilt']
-        return None
+        return self._tilt_angle
+
+    def pan_centidegrees(self):
+        return self._pan
+
+    def tilt_centidegrees(self):
+        return self._tilt
 
     def pan_bytes(self):
         if self._valid:
-            return self._phi
+            return self._bytes[:2]
         return None
 
     def tilt_bytes(self):
         if self._valid:
-            return self._theta
+            return self._bytes[2:]
         return None
 
     def pan_hex(self):
         if self._valid:
-            return self._phi.hex('-')
+            return self._bytes[:2].hex('-')
         return None
 
     def tilt_hex(self):
         if self._valid:
-            return self._theta.hex('-')
+            return self._bytes[2:].hex('-')
         return None
 
     def to_bytes(self):
-        if self._valid:
-            return self._phi + self._theta
-        return None
+        return self._bytes
 
     def to_hex(self):
         if self._valid:
-            return (self._phi + self._theta).hex('-')
+            return self._bytes.hex('-')
         return None
 """End Coordinate Class"""
 
+
+class CoordinateArray:
+    """CoordinateArray: vectorized companion of Coordinate for many positions,
+    e.g. logged telemetry or the points of a scan. Positions are stored as
+    int16 centidegree numpy arrays with one pair of offsets for the array.
+    """
+    __slots__ = ('pan', 'tilt', 'offsets')
+
+    def __init__(self, pan, tilt, offsets=(0.0, 0.0)):
+        """pan and tilt are sequences of centidegree ints"""
+        self.pan = np.asarray(pan, dtype=np.int16)
+        self.tilt = np.asarray(tilt, dtype=np.int16)
+        self.offsets = tuple(offsets)
+
+    @classmethod
+    def from_angles(cls, pan, tilt, offsets=(0.0, 0.0)):
+        """Builds an array from angles in degrees, raises an Exception if any
+        angle is outside the range of the positioner"""
+        pan_offset, tilt_offset = offsets
+        pan = np.asarray(pan, dtype=float)
+        tilt = np.asarray(tilt, dtype=float)
+        if np.any(np.abs(pan - pan_offset) > Coordinate.MAX_AZ) \
+           or np.any(np.abs(tilt - tilt_offset) > Coordinate.MAX_EL):
+            raise Exception('Angles outside of the positioner limits')
+        return cls(np.rint((pan - pan_offset) * 100), np.rint((tilt - tilt_offset) * 100), offsets)
+
+    @classmethod
+    def from_bytes(cls, data, offsets=(0.0, 0.0)):
+        """Builds an array from concatenated 4 byte wire positions (pan, tilt)"""
+        raw = np.frombuffer(data, dtype='<i2').reshape(-1, 2)
+        return cls(raw[:, 0], raw[:, 1], offsets)
+
+    @classmethod
+    def from_coordinates(cls, coords):
+        """Builds an array from Coordinates, which must share their offsets"""
+        coords = list(coords)
+        offsets = coords[0]._offsets if coords else (0.0, 0.0)
+        return cls([c._pan for c in coords], [c._tilt for c in coords], offsets)
+
+    def __len__(self):
+        return len(self.pan)
+
+    def __getitem__(self, i):
+        return Coordinate(int(self.pan[i]), int(self.tilt[i]), fromqpt=True, offsets=self.offsets)
+
+    def pan_angles(self):
+        return self.pan / 100 + self.offsets[0]
+
+    def tilt_angles(self):
+        return self.tilt / 100 + self.offsets[1]
+
+    def to_bytes(self):
+        """Returns the positions as concatenated 4 byte wire positions"""
+        raw = np.empty((len(self.pan), 2), dtype='<i2')
+        raw[:, 0] = self.pan
+        raw[:, 1] = self.tilt
+        return raw.tobytes()
+"""End CoordinateArray Class"""
+
+
+def _wire(value):
+    """Returns the 2 byte wire value of a received value or a centidegree int"""
+    if value.__class__ is bytes:
+        return value
+    if isinstance(value, int):
+        return _SINGLE.pack(value)
+    return bytes(value)
+
+
+# Coordinate is immutable, so its slots are written through their descriptors
+_set_pan        = Coordinate._pan.__set__
+_set_tilt       = Coordinate._tilt.__set__
+_set_pan_angle  = Coordinate._pan_angle.__set__
+_set_tilt_angle = Coordinate._tilt_angle.__set__
+_set_bytes      = Coordinate._bytes.__set__
+_set_offsets    = Coordinate._offsets.__set__
+_set_valid      = Coordinate._valid.__set__
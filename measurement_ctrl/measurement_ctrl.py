@@ -20,7 +20,10 @@ import measurement_ctrl.vna_comms as vna_comms
 import measurement_ctrl.positioner as positioner
 from measurement_ctrl.integer import Coordinate
 import measurement_ctrl.data_storage as data_storage
-from time import sleep
+import measurement_ctrl.vna_timing as vna_timing
+from measurement_ctrl.position_monitor import PositionMonitor
+from time import sleep, perf_counter, monotonic
+import numpy as np
 from threading import Lock, Thread, local
 import pyvisa as visa
 import sys
@@ -44,11 +47,18 @@ class MeasurementCtrlSignals(qtc.QObject):
     startLockClock = qtc.pyqtSignal()
     calReady       = qtc.pyqtSignal()
     error          = qtc.pyqtSignal()
+    waiting        = qtc.pyqtSignal(bool ) # waiting on the positioner, to have it polled fast
 """End MeasurementCtrlSignals Class"""
 
 
 class MeasurementCtrl(qtc.QObject):
-    def __init__(self, args, data_file='data\\data0.csv'):
+    TELEMETRY_EXTRAPOLATE = .3 # seconds angles may be extrapolated past the newest telemetry
+    SETTLE_TIMEOUT = 5 # seconds, plus the move distance at SETTLE_MIN_RATE, to wait for a move to settle
+    SETTLE_MIN_RATE = 2.0 # deg/s, below the slowest automated move; stalls are reported after 3 s
+    SETTLE_TOLERANCE = .05 # deg, five counts of the positioner resolution
+    SETTLE_TOLERANCE_FRACTION = .02 # of the sweep resolution, if that is coarser than SETTLE_TOLERANCE
+
+    def __init__(self, args, data_file='data\\data0.csv', vna_rm=None, telemetry=None):
         super().__init__()
         self.impedance = args['impedance']  # if true, S11 and S21 will be measured. Else, only S21
         if args['list'] is not None:          # list or vna_comms.lin_freq obj
@@ -62,7 +72,10 @@ class MeasurementCtrl(qtc.QObject):
         self.exe_mode = args['sweep_axis'] # 'pan' for pan sweep or 'tilt' for tilt sweep
         self.const_angle = args['fixed_angle'] # angle at which non-changing coordinate is set to
         self.resolution = args['resolution']
-        self.vna = vna_comms.Session('GPIB0::' + str(args['gpib_addr']) + '::INSTR')
+        self.settle_tolerance = max(self.SETTLE_TOLERANCE, self.SETTLE_TOLERANCE_FRACTION * self.resolution)
+        self.if_bw = 3700 # IF bandwidth of the vna in Hz
+        self.vna = vna_comms.Session('GPIB0::' + str(args['gpib_addr']) + '::INSTR',
+                                     headless=args.get('headless', False), rm=vna_rm)
         self.progress = 0 # percentage, e.g. 11 for 11%
         self.vna_avg_delay = 0
         self.vna_S11_delay = 0
@@ -70,9 +83,16 @@ class MeasurementCtrl(qtc.QObject):
         self.pan_speed = 0
         self.tilt_speed = 0
         self.vna_lock = Lock()
+        self.transfer = None # thread transferring and storing the last step trace
+        self.transfer_error = None # exception raised in the transfer thread
         self.file = data_file
+        self.writer = data_storage.create_writer(data_file, args.get('flush_every', 1))
         self.pan = -1
         self.tilt = -1
+        self.positions = PositionMonitor(self.pan, self.tilt) # wakes waits on the positioner
+        self.telemetry = telemetry # positioner TelemetryBuffer, to tag continuous traces
+        self.point_angles = args.get('point_angles', False) # tag every point of a continuous trace
+        self.sweep_start = None # monotonic time averaging of the current continuous trace began
 
         # Jog speed limits
         self.MAX_PAN_TIME = 1240
@@ -95,6 +115,7 @@ class MeasurementCtrl(qtc.QObject):
 
         self.signals = MeasurementCtrlSignals()
         self.error_message = None
+        self.positions.on_waiting = self.signals.waiting.emit # poll fast while waiting
 
 
     def setup(self):
@@ -118,7 +139,7 @@ class MeasurementCtrl(qtc.QObject):
                 self.vna.reset()
 
             # Configure the vna and calculate vna delays
-            self.vna.setup(self.freq, self.avg, 3700)
+            self.vna.setup(self.freq, self.avg, self.if_bw)
 
             # Calibrate vna if needed
             if self.cal is True:
@@ -184,7 +205,7 @@ class MeasurementCtrl(qtc.QObject):
                 self.setup()
                 if self.impedance is True:
                     self.vna.rst_avg('S11')
-                    sleep(self.vna_avg_delay)
+                    self.wait_avg()
                     self.record_data('S11', self.file)    # need to create_file prior
 
             if self.pause_move:
@@ -193,6 +214,7 @@ class MeasurementCtrl(qtc.QObject):
                 # in which self.pause_move would be true at this point of execution
                 # for the run() function. If the pause button was pressed, clear the
                 # pause_move flag, then return from the run to stop the thread of execution
+                self.writer.sync()
                 self.signals.runPaused.emit()
                 self.pause_move = False
                 return None
@@ -223,13 +245,12 @@ class MeasurementCtrl(qtc.QObject):
                             # azimuth angle to be measured, and then move positioner there
                             self.resume = False
                             target = (i * self.resolution) - 180
-                            self.signals.requestMoveTo.emit(
-                                [target, self.const_angle, 'abs']
-                            )
-                            self.wait_on_pan_cw(target)
-                        # Delay for vna reset, take measurement, then update progress
+                            self.move_and_settle(target, self.const_angle)
+                        # Delay for vna reset, then hold the averaged trace and
+                        # start transferring it in the background, so that the
+                        # next move does not wait on the transfer, then update progress
                         self.step_delay()
-                        self.record_data('S21', self.file)
+                        self.start_transfer('S21')
                         self.progress = int(i * self.resolution / 360 * 100)
                         if self.progress > 100:
                             self.progress = 100
@@ -265,10 +286,7 @@ class MeasurementCtrl(qtc.QObject):
                             # move the positioner to that location
                             i = i + 1
                             target = (i * self.resolution) - 180
-                            self.signals.requestMoveTo.emit(
-                                [target, self.const_angle, 'abs'] 
-                            )
-                            self.wait_on_pan_cw(target)
+                            self.move_and_settle(target, self.const_angle)
                 #------------------------------------------------------------------
             #----------------------------------------------------------------------
 
@@ -319,20 +337,26 @@ class MeasurementCtrl(qtc.QObject):
                         # while loop forces the thread to wait on the lock to be released
                         lock = self.init_cont_lock()
                         target = (i * self.resolution) - 180
-                        while lock.acquire(blocking=False) is not True:
+                        while lock.acquire(timeout=.2) is not True:
                             if self.stop:
                                 break
-                            sleep(.2)
-                            while self.pan < target:
-                                if self.stop:
-                                    break
-                                sleep(.2)
-                        # print(i, ' ', target)
-                        self.record_data('S21', self.file)
-                        self.progress = int((target + 180) / 360 * 100)
-                        if self.progress > 100:
-                            self.progress = 100
-                        self.signals.progress.emit(self.progress)
+                        if not self.stop:
+                            # On stop the averaging may still be going on, so no trace is read
+                            reached = self.positions.wait_for(lambda pan, tilt: pan >= target,
+                                                              self.pan_jog_timeout(target))
+                            if not reached and not self.stop:
+                                # The positioner stalled or faulted short of the target, so
+                                # stop jogging and end the sweep through the error path
+                                self.pause_jog = True
+                                if Thread_Jog.is_alive():
+                                    Thread_Jog.join()
+                                raise Exception('Positioner stopped short of pan {:.2f}'.format(target))
+                            # print(i, ' ', target)
+                            self.record_data('S21', self.file)
+                            self.progress = int((target + 180) / 360 * 100)
+                            if self.progress > 100:
+                                self.progress = 100
+                            self.signals.progress.emit(self.progress)
 
                         # Check if sweep should be paused, stopped, or if it is completed
                         if self.is_continuous_pan_complete() is True:
@@ -371,23 +395,98 @@ class MeasurementCtrl(qtc.QObject):
                 #------------------------------------------------------------------
             #----------------------------------------------------------------------
 
+            # Wait for the last step trace to be stored before closing out the data file
+            self.finish_transfer()
+
+            # Close out the data file: a finished sweep gets the row of nulls
+            # and the file closed, a stopped sweep gets the file closed, and a
+            # paused sweep keeps the file open but forces its contents to disk
             if self.finished is True:
-                with open(self.file, 'a') as file:
-                    file.write("null,null,null,null,null,null\n")
+                self.writer.write_end()
+                self.writer.close()
                 self.signals.runComplete.emit()
+            elif self.stop is True:
+                self.writer.close()
+            else:
+                self.writer.sync()
+            # Let the vna sweep again while the positioner is idle, once any
+            # averaging wait still running on the delay thread is over
+            with self.vna_lock:
+                if self.vna.held:
+                    self.vna.resume_sweep()
         except Exception as e:
+            if self.transfer is not None:
+                self.transfer.join()
+                self.transfer = None
+            self.writer.close()
             self.error_message = str(e)
             self.signals.error.emit()
 
 
     def step_delay(self):
-        self.vna.rst_avg('S21')
-        sleep(self.vna_avg_delay)
+        # The previous trace has to be read out before the averaging is reset
+        self.finish_transfer()
+        with self.vna_lock:
+            self.vna.rst_avg('S21')
+        self.wait_avg()
+
+
+    def wait_avg(self):
+        """Returns as soon as the vna reports averaging complete. If the vna can
+        not report it, or does not within twice the expected time, waits out
+        the remainder of the measured averaging delay instead"""
+        start = perf_counter()
+        with self.vna_lock:
+            done = self.vna.wait_avg_complete(self.avg, 2 * self.vna_avg_delay + 1)
+        if not done:
+            remaining = self.vna_avg_delay - (perf_counter() - start)
+            if remaining > 0:
+                sleep(remaining)
+
+
+    def start_transfer(self, s):
+        """Holds the averaged trace and transfers, decodes and stores it on a
+        separate thread, so the positioner can move while the data is read out.
+        The coordinates are taken now, before the positioner starts moving."""
+        self.finish_transfer()
+        theta, phi = self.tilt, self.pan
+        with self.vna_lock:
+            if not self.vna.held:
+                self.vna.hold()
+        self.transfer = Thread(target=self.transfer_data, args=(s, theta, phi), daemon=True)
+        self.transfer.start()
+
+
+    def transfer_data(self, s, theta, phi):
+        try:
+            with self.vna_lock:
+                trace = self.vna.get_data(theta, phi, s)
+            self.writer.write(trace)
+        except Exception as e:
+            self.transfer_error = e
+
+
+    def finish_transfer(self):
+        """Waits for the transfer thread, raising any exception it ran into"""
+        if self.transfer is not None:
+            self.transfer.join()
+            self.transfer = None
+        if self.transfer_error is not None:
+            e = self.transfer_error
+            self.transfer_error = None
+            raise e
 
 
     def continuous_delay(self, lock):
-        with lock:
-            sleep(self.vna_avg_delay)
+        # lock is acquired before this thread starts and released once averaging
+        # is complete; sweeping is resumed so the trace follows the moving positioner
+        try:
+            self.wait_avg()
+            with self.vna_lock:
+                if self.vna.held:
+                    self.vna.resume_sweep()
+        finally:
+            lock.release()
 
 
     def send_pan_jog(self):
@@ -428,7 +527,9 @@ class MeasurementCtrl(qtc.QObject):
 
     def init_cont_sweep(self):
         lock = Lock()
+        lock.acquire()
         self.vna.rst_avg('S21')
+        self.sweep_start = monotonic()
         t1 = Thread(target=self.continuous_delay, args=(lock,), daemon=True)
         t1.start()                
         t1.join()
@@ -437,7 +538,9 @@ class MeasurementCtrl(qtc.QObject):
 
     def init_cont_lock(self):
         lock = Lock()
+        lock.acquire()
         self.vna.rst_avg('S21')
+        self.sweep_start = monotonic()
         t2 = Thread(target=self.continuous_delay, args=(lock,), daemon=True)
         t2.start()
         return lock
@@ -453,20 +556,82 @@ class MeasurementCtrl(qtc.QObject):
         self.resume = True
 
 
+    @property
+    def stop(self):
+        return self._stop
+
+    @stop.setter
+    def stop(self, stop):
+        # Stopping also wakes the measurement thread if it waits on the positioner
+        self._stop = stop
+        if stop:
+            self.positions.cancel()
+        else:
+            self.positions.reset()
+
+
     @qtc.pyqtSlot(float)
     def update_pan(self, pan):
         self.pan = pan
+        self.positions.update_pan(pan)
 
     @qtc.pyqtSlot(float)
     def update_tilt(self, tilt):
         self.tilt = tilt
+        self.positions.update_tilt(tilt)
+
+    @qtc.pyqtSlot(bool)
+    def update_moving(self, moving):
+        self.positions.update_moving(moving)
+
+    @qtc.pyqtSlot(bool, float, float)
+    def update_settled(self, reached, pan, tilt):
+        self.positions.update_settled(reached, pan, tilt)
 
 
     def record_data(self, s, file):
         if s == 'S21':
-            data_storage.append_data(file, self.vna.get_data(self.tilt, self.pan, s))
+            with self.vna_lock:
+                end = monotonic() # the trace is copied to memory as soon as get_data starts
+                trace = self.vna.get_data(self.tilt, self.pan, s)
+            if self.sweep_start is not None:
+                self.tag_sweep(trace, self.sweep_start, end)
+            self.writer.write(trace)
         else:
-            data_storage.append_data(file, self.vna.get_data(0, 0, s))
+            with self.vna_lock:
+                trace = self.vna.get_data(0, 0, s)
+            self.writer.write(trace)
+
+
+    def tag_sweep(self, trace, start, end):
+        """Stamps a trace taken while the positioner moved with the time it was
+        averaged over, and replaces its angles by the ones interpolated from the
+        positioner telemetry at the middle of that time. Averaging runs on after
+        avg sweeps, so the trace covers at most the last averaging delay.
+
+        With point_angles, each point gets its own phi: point k of n is measured
+        a fraction (k + .5)/n into every one of the avg sweeps, and on average in
+        the middle one. The newest telemetry can be up to a poll period older than
+        the end of the sweep, so the angles are extrapolated for a short time
+        past it. The angles the trace was read with are kept when the telemetry
+        does not cover the sweep."""
+        start = max(start, end - self.vna_avg_delay)
+        trace.sweep_start = start
+        trace.sweep_end = end
+        if self.telemetry is None:
+            return
+        if self.point_angles:
+            sweep = (end - start) / self.avg
+            points = len(trace)
+            times = start + (self.avg - 1) / 2 * sweep + (np.arange(points) + .5) / points * sweep
+        else:
+            times = (start + end) / 2
+        angles = self.telemetry.interpolate(times, self.TELEMETRY_EXTRAPOLATE)
+        if angles is None:
+            return
+        pan, tilt = angles
+        trace.theta = float(np.mean(tilt))
+        trace.phi = pan if self.point_angles else float(pan)
 
 
     def is_continuous_pan_complete(self):
@@ -481,58 +646,69 @@ class MeasurementCtrl(qtc.QObject):
         return False
 
 
-    def wait_on_pan_cw(self, target):
-        count = 0
-        while self.pan <= target:
-            sleep(0.2)
-            count = count + 1
-            if count >= 25:
-                break
+    def move_and_settle(self, pan, tilt):
+        """Moves the positioner to (pan, tilt) within settle_tolerance, then waits
+        for the move to settle, as reported by the positioner from its status bits
+        and motion, or for the measurement to be stopped. A move that does not
+        reach the target is retried once; if that fails too, the error is logged
+        and the measurement goes on at the angles the positioner reports, which
+        are the ones recorded with the data. Returns True if the target was reached"""
+        for attempt in range(2):
+            distance = max(abs(pan - self.positions.pan), abs(tilt - self.positions.tilt))
+            timeout = self.SETTLE_TIMEOUT + distance / self.SETTLE_MIN_RATE
+            settles = self.positions.settles
+            self.signals.requestMoveTo.emit([pan, tilt, 'abs', self.settle_tolerance])
+            if self.positions.wait_settled(pan, tilt, settles, timeout) is True:
+                return True
+            if self.stop:
+                return False
+        print('Positioner did not settle at pan {:.2f}, tilt {:.2f}; measuring at pan {:.2f}, tilt {:.2f}'
+              .format(pan, tilt, self.positions.pan, self.positions.tilt))
+        return False
 
 
-    def wait_on_pan_ccw(self, target):
-        count = 0
-        while self.pan >= target:
-            sleep(0.2)
-            count = count + 1
-            if count >= 25:
-                break
+    def pan_jog_timeout(self, target):
+        """Seconds a continuous pan jog may take to reach target: twice the time
+        at the nominal jog rate (inverse of compute_pan_speed), plus SETTLE_TIMEOUT"""
+        rate = (max(self.pan_speed, self.MIN_PAN_SPEED) - 3.1546) / 12.8866
+        distance = max(0.0, target - self.positions.pan)
+        return self.SETTLE_TIMEOUT + 2 * distance / rate
 
 
+    # The waits below return as soon as the positioner reports the target angle,
+    # stops short of it, or the measurement is stopped, else after the timeout
     def wait_on_pan_setup(self, target):
-        count = 0
-        while self.pan > (target+1) and self.stop is not True:
-            sleep(0.2)
-            count = count + 1
-            if count > 300:
-                break
+        self.positions.wait_for(lambda pan, tilt: pan <= target + 1, 60)
 
 
     def wait_on_tilt_setup(self, target):
-        count = 0
-        while self.tilt < (target+1):
-            sleep(0.2)
-            count = count + 1
-            if count > 300:
-                break
-
-
-    def wait_on_tilt_up(self, target):
-        count = 0
-        while self.tilt <= target or count <= 25:
-            sleep(0.2)
-            count = count + 1
+        self.positions.wait_for(lambda pan, tilt: tilt >= target + 1, 60)
 
 
-    def wait_on_tilt_down(self, target):
-        count = 0
-        while self.tilt >= target or count <= 25:
-            sleep(0.2)
-            count = count + 1
+    # returns list w/ 3 numbers in seconds, [averaging delay, get_data delay (S11), get_data delay (S21)]
+    # The delays are measured on the connected vna the first time a sweep configuration
+    # is used and cached next to the data file; the table is used if measuring fails
+    def compute_vna_delay(self):
+        path = vna_timing.cache_path(self.file)
+        key = vna_timing.timing_key(self.vna.model, self.freq, self.avg, self.if_bw)
+        delays = vna_timing.lookup(path, key)
+        if delays is not None:
+            return delays
+        table = self.table_vna_delay()
+        try:
+            # Averaging is given as long as it takes in the worst case, as in wait_avg
+            delays = vna_timing.measure(self.vna, self.avg, 2 * table[0] + 1)
+        except Exception:
+            return table
+        try:
+            vna_timing.store(path, key, delays)
+        except OSError:
+            pass
+        return delays
 
 
-    # returns list w/ 3 numbers in seconds, [averaging delay, get_data delay (S11), get_data delay (S21)]
-    def compute_vna_delay(self):        
+    # returns the worst case delays measured for the HP 8753D, in the same form as compute_vna_delay
+    def table_vna_delay(self):
         if isinstance(self.freq, list):
             if len(self.freq) <= 5:
                 if self.avg <= 8:
@@ -23,10 +23,8 @@
 # For any questions, contact Thomas at tomhoover1@gmail.com
 ################################################################################
 import measurement_ctrl.integer as qi
-from measurement_ctrl.constants import CTRL, ESC, ESC_MASK, STATIC_TX
-
-
-ctrl_chars = CTRL.values()
+import measurement_ctrl.codec as codec
+from measurement_ctrl.constants import STATIC_TX
 
 
 def generate_LRC(data):
@@ -35,10 +33,7 @@ def generate_LRC(data):
     data: Bytes representing the command number and packet data to be transmitted.
     returns: Byte representation of the LRC checksum for the given data.
     """
-    checksum = 0
-    for item in data:
-        checksum = checksum ^ item
-    return (checksum).to_bytes(1, byteorder='little')
+    return codec.generate_LRC(data)
 
 
 def valid_LRC(data):
@@ -49,10 +44,7 @@ def valid_LRC(data):
     returns: True if the transmitted LRC checksum matches the calculated 
         LRC checksum
     """
-    checksum = generate_LRC(data)
-    if checksum == b'\x00':
-        return True
-    return False
+    return codec.valid_LRC(data)
 
 
 def insert_esc(data):
@@ -64,16 +56,7 @@ def insert_esc(data):
         control chars.
     returns: Packet that is ready to transmit once STX and ETX are added.
     """
-    tx_packet = bytes()
-    # ctrl = CTRL.values()
-    for item in data:
-        val = item.to_bytes(1, byteorder='little')
-        if val in ctrl_chars or val == ESC:
-            tx_packet += b'\x1b'
-            tx_packet += (item | ESC_MASK).to_bytes(1, byteorder='little')
-        else:
-            tx_packet += val
-    return tx_packet
+    return codec.escape(data)
 
 
 def strip_esc(data):
@@ -85,18 +68,7 @@ def strip_esc(data):
         control chars.
     returns: Packet that is ready to be parsed.
     """
-    rx = list(data)
-    rx_packet = bytes()
-    include_next = False
-    for i in range(len(rx)):
-        val = rx[i].to_bytes(1, byteorder='little')
-        if val != ESC or include_next is True:
-            rx_packet += val
-            include_next = False
-        else:
-            rx[i+1] = (rx[i+1] & (~ESC_MASK))
-            include_next = True
-    return rx_packet
+    return codec.unescape(data)
 
 
 def get_status():
@@ -140,8 +112,7 @@ def jog_positioner(
             tx_data = bytes(b'\x31' + b'\x04' + pan + tilt + b'\x00\x00')
         else:
             tx_data = bytes(b'\x31' + b'\x00' + pan + tilt + b'\x00\x00')
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
 
@@ -189,8 +160,7 @@ def move_to_entered_coords(coord):
     returns: Packet that is ready to transmit.
     """
     tx_data = bytes(b'\x33' + coord.to_bytes())
-    LRC = generate_LRC(tx_data)
-    return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+    return codec.frame(tx_data)
 
 
 def move_to_delta_coords(coord):
@@ -201,8 +171,7 @@ def move_to_delta_coords(coord):
     returns: Packet that is ready to transmit.
     """
     tx_data = bytes(b'\x34' + coord.to_bytes())
-    LRC = generate_LRC(tx_data)
-    return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+    return codec.frame(tx_data)
 
 
 def move_to_absolute_zero():
@@ -239,8 +208,7 @@ def get_soft_limit(axis):
     """
     if axis in range(4):
         tx_data = bytes(b'\x71' + (axis).to_bytes(1, byteorder='little'))
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
 
@@ -257,8 +225,7 @@ def set_angle_correction(coord):
     """
     if coord is not None:
         tx_data = bytes(b'\x80' + coord.to_bytes())
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
 
@@ -278,8 +245,7 @@ def set_soft_limit_to_current_position(axis):
     """
     if axis in range(4):
         tx_data = bytes(b'\x81' + (axis).to_bytes(1, byteorder='little'))
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
 
@@ -347,8 +313,7 @@ def set_minimum_speeds(pan_speed, tilt_speed):
         p = (pan_speed).to_bytes(1, byteorder='little')
         t = (tilt_speed).to_bytes(1, byteorder='little')
         tx_data = bytes(b'\x93' + p + t)
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
 
@@ -365,12 +330,10 @@ def get_set_communication_timeout(query, timeout):
     """
     if query is True:
         tx_data = bytes(b'\x96\x80')
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     elif query is False and timeout >= 0 and timeout <= 120:
         tx_data = timeout.to_bytes(1, byteorder='little')
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
 
@@ -399,7 +362,6 @@ def set_maximum_speeds(pan_speed, tilt_speed):
         p = (pan_speed).to_bytes(1, byteorder='little')
         t = (tilt_speed).to_bytes(1, byteorder='little')
         tx_data = bytes(b'\x99' + p + t)
-        LRC = generate_LRC(tx_data)
-        return bytes(b'\x02' + insert_esc(tx_data + LRC) + b'\x03')
+        return codec.frame(tx_data)
     return None
 
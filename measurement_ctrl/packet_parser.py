@@ -20,37 +20,96 @@
 # Built with Python Version: 3.8.5
 # For any questions, contact Thomas at tomhoover1@gmail.com
 ################################################################################
-from time import time, sleep
+from time import time, sleep, monotonic
 import measurement_ctrl.integer as qi
 import measurement_ctrl.packet as pkt
 from measurement_ctrl.constants import BIT0, BIT1, BIT2, BIT3, BIT4, BIT5, BIT6, BIT7
 
 
+# Status flags of a status frame: name -> (index into the three status bytes, bit)
+# The status bytes are the pan status (rx[6]), tilt status (rx[7]), and general
+# status (rx[8]) bytes of replies to the move and status commands
+STATUS_FLAGS = {
+    # Pan Status
+    'sfault_cw_soft_limit'        : (0, BIT7),
+    'sfault_ccw_soft_limit'       : (0, BIT6),
+    'hfault_cw_hard_limit'        : (0, BIT5),
+    'hfault_ccw_hard_limit'       : (0, BIT4),
+    'hfault_pan_timeout'          : (0, BIT3),
+    'hfault_pan_direction_error'  : (0, BIT2),
+    'hfault_pan_current_overload' : (0, BIT1),
+    'sfault_pan_resolver_fault'   : (0, BIT0),
+
+    # Tilt Status
+    'sfault_up_soft_limit'         : (1, BIT7),
+    'sfault_down_soft_limit'       : (1, BIT6),
+    'hfault_up_hard_limit'         : (1, BIT5),
+    'hfault_down_hard_limit'       : (1, BIT4),
+    'hfault_tilt_timeout'          : (1, BIT3),
+    'hfault_tilt_direction_error'  : (1, BIT2),
+    'hfault_tilt_current_overload' : (1, BIT1),
+    'sfault_tilt_resolver_fault'   : (1, BIT0),
+
+    # General Status
+    'status_high_res'            : (2, BIT7),
+    'status_executing'           : (2, BIT6),
+    'status_dest_coords'         : (2, BIT5),
+    'status_soft_limit_override' : (2, BIT4),
+    'pan_status_cw_moving'       : (2, BIT3),
+    'pan_status_ccw_moving'      : (2, BIT2),
+    'tilt_status_up_moving'      : (2, BIT1),
+    'tilt_status_down_moving'    : (2, BIT0),
+}
+
+
+class StatusState:
+    """Compact copy of the last status frame: the raw position and status bytes.
+    Flags are only decoded when they are read, see flag()"""
+    __slots__ = ('position', 'status')
+
+    def __init__(self):
+        self.position = bytes(4) # pan and tilt, as sent by the QPT
+        self.status = bytes([BIT7, 0, 0]) # pan, tilt and general status bytes
+
+    def update(self, position, status):
+        """Stores new raw bytes, position may be None to keep the current one.
+        Returns True if anything changed"""
+        changed = status != self.status
+        self.status = status
+        if position is not None and position != self.position:
+            self.position = position
+            changed = True
+        return changed
+
+    def flag(self, name):
+        index, mask = STATUS_FLAGS[name]
+        return bool(self.status[index] & mask)
+
+    def faults(self, index):
+        """Returns the names of the flags set in status byte index (0 pan, 1 tilt)"""
+        return tuple(name for name, (i, mask) in STATUS_FLAGS.items()
+                     if i == index and self.status[index] & mask)
+"""End StatusState Class"""
+
+
 class Parser:
     def __init__(self):
         self.active = True 
+        # Bind the handler of every command once, so parsing is a single lookup
+        self.dispatch = {cmd: getattr(self, name) for cmd, name in DISPATCH.items()}
 
 
     def parse(self, rx, qpt):
+        """Updates qpt from a received frame. Sets qpt.changed if the positioner
+        state changed, and returns True in that case"""
         if rx is not None:
             rx = bytes(pkt.strip_esc(rx))
-            cmd = rx[1]
-
-            if pkt.valid_LRC(rx[1:-1]) is True:
-                if is_move_cmd(cmd):
-                    self.update_qpt_status(rx, qpt)
-                elif is_angle_correction_cmd(cmd):
-                    self.update_angle_corrections(rx, qpt)
-                elif is_soft_limits_cmd(cmd):
-                    self.update_soft_limits(rx, qpt)
-                elif is_potentiometer_center_cmd(cmd):
-                    self.update_potentiometer_center(rx, qpt)
-                elif is_min_speed_cmd(cmd):
-                    self.update_min_speed(rx, qpt)
-                elif is_max_speed_cmd(cmd):
-                    self.update_max_speed(rx, qpt)
-                elif is_comm_timeout_cmd(cmd):
-                    self.update_comm_timeout(rx, qpt)
+            handler = self.dispatch.get(rx[1])
+            if handler is not None and pkt.valid_LRC(rx[1:-1]) is True:
+                if handler(rx, qpt) is not False:
+                    qpt.changed = True
+                    return True
+        return False
 
 
     def update_curr_position(self, rx, qpt):
@@ -60,45 +119,22 @@ class Parser:
             qpt.signals.currentTilt.emit('{:0.2f}'.format(qpt.curr_position.tilt_angle()))
 
 
-    def update_pan_status(self, rx, qpt):
-        qpt.sfault_cs_soft_limit = bool(rx[6] & BIT7)
-        qpt.sfault_ccw_soft_limit = bool(rx[6] & BIT6)
-        qpt.hfault_cw_hard_limit = bool(rx[6] & BIT5)
-        qpt.hfault_ccw_hard_limit = bool(rx[6] & BIT4)
-        qpt.hfault_pan_timeout = bool(rx[6] & BIT3)
-        qpt.hfault_pan_direction_error = bool(rx[6] & BIT2)
-        qpt.hfault_pan_current_overload = bool(rx[6] & BIT1)
-        qpt.sfault_pan_resolver_fault = bool(rx[6] & BIT0)
-
-
-    def update_tilt_status(self, rx, qpt):
-        qpt.sfault_up_soft_limit = bool(rx[7] & BIT7)
-        qpt.sfault_down_soft_limit = bool(rx[7] & BIT6)
-        qpt.hfault_up_hard_limit = bool(rx[7] & BIT5)
-        qpt.hfault_down_hard_limit = bool(rx[7] & BIT4)
-        qpt.hfault_tilt_timeout = bool(rx[7] & BIT3)
-        qpt.hfault_tilt_direction_error = bool(rx[7] & BIT2)
-        qpt.hfault_tilt_current_overload = bool(rx[7] & BIT1)
-        qpt.sfault_tilt_resolver_fault = bool(rx[7] & BIT0)
-
-
-    def update_general_status(self, rx, qpt):
-        qpt.status_high_res = bool(rx[8] & BIT7)
-        qpt.status_executing = bool(rx[8] & BIT6)
-        qpt.status_dest_coords = bool(rx[8] & BIT5)
-        qpt.status_soft_limit_override = bool(rx[8] & BIT4)
-        qpt.pan_status_cw_moving = bool(rx[8] & BIT3)
-        qpt.pan_status_ccw_moving = bool(rx[8] & BIT2)
-        qpt.tilt_status_up_moving = bool(rx[8] & BIT1)
-        qpt.tilt_status_down_moving = bool(rx[8] & BIT0)
-
-
     def update_qpt_status(self, rx, qpt):
+        """Stores the raw status bytes; flags are decoded by StatusState when read.
+        Returns False if nothing changed since the last status frame"""
         if rx[1] == 0x31:
-            self.update_curr_position(rx, qpt)
-        self.update_pan_status(rx, qpt)
-        self.update_tilt_status(rx, qpt)
-        self.update_general_status(rx, qpt)
+            position = rx[2:6]
+            moved = position != qpt.status_state.position
+            changed = qpt.status_state.update(position, rx[6:9])
+            if moved:
+                self.update_curr_position(rx, qpt)
+            if qpt.telemetry is not None:
+                curr = qpt.curr_position
+                qpt.telemetry.append(monotonic(), curr.pan_angle(), curr.tilt_angle(),
+                                     rx[6] << 16 | rx[7] << 8 | rx[8])
+        else:
+            changed = qpt.status_state.update(None, rx[6:9])
+        return changed
 
 
     def update_soft_limits(self, rx, qpt):
@@ -182,3 +218,25 @@ def is_comm_timeout_cmd(cmd):
         return True
     return False
 
+
+def handler_name(cmd):
+    """Returns the name of the Parser method handling replies to cmd, or None"""
+    if is_move_cmd(cmd):
+        return 'update_qpt_status'
+    elif is_angle_correction_cmd(cmd):
+        return 'update_angle_corrections'
+    elif is_soft_limits_cmd(cmd):
+        return 'update_soft_limits'
+    elif is_potentiometer_center_cmd(cmd):
+        return 'update_potentiometer_center'
+    elif is_min_speed_cmd(cmd):
+        return 'update_min_speed'
+    elif is_max_speed_cmd(cmd):
+        return 'update_max_speed'
+    elif is_comm_timeout_cmd(cmd):
+        return 'update_comm_timeout'
+    return None
+
+
+# Handler of every command byte, built once from the helpers above
+DISPATCH = {cmd: handler_name(cmd) for cmd in range(256) if handler_name(cmd) is not None}
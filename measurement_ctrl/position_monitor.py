@@ -0,0 +1,133 @@
+################################################################################
+#  position_monitor
+#
+#  Description: Lets the measurement thread sleep until the positioner reaches
+#               a position, instead of polling the last reported angles. The
+#               QPTMaster signals feed the reported pan, tilt and motion state
+#               in through MeasurementCtrl's slots, and every update wakes the
+#               waiting thread, which checks its condition right away. The
+#               end of automated moves, as decided by the positioner's settle
+#               detector, is fed in the same way.
+#  Dependencies: n/a
+#
+#  Built with Python Version: 3.8.5
+################################################################################
+from threading import Condition
+from time import monotonic
+
+
+class PositionMonitor:
+    """Last reported position of the positioner, with waits on it.
+
+    A wait ends as soon as its condition on (pan, tilt) holds. It also ends
+    when the positioner stops moving after the wait began, since it will not
+    get any closer to the target, when cancel() is called, or on timeout.
+
+    on_waiting, if given, is called with True when a wait begins and with
+    False when it ends, e.g. to have the positioner polled faster meanwhile."""
+    def __init__(self, pan=-1, tilt=-1, on_waiting=None):
+        self.condition = Condition()
+        self.on_waiting = on_waiting
+        self.pan = pan
+        self.tilt = tilt
+        self.moving = False
+        self.stops = 0 # number of times the positioner was reported to stop moving
+        self.settled = None # (reached, target pan, target tilt) of the last settled move
+        self.settles = 0 # number of moves reported settled
+        self.cancelled = False
+
+    def update_pan(self, pan):
+        with self.condition:
+            self.pan = pan
+            self.condition.notify_all()
+
+    def update_tilt(self, tilt):
+        with self.condition:
+            self.tilt = tilt
+            self.condition.notify_all()
+
+    def update_moving(self, moving):
+        with self.condition:
+            if self.moving and not moving:
+                self.stops = self.stops + 1
+            self.moving = moving
+            self.condition.notify_all()
+
+    def update_settled(self, reached, pan, tilt):
+        with self.condition:
+            self.settled = (reached, pan, tilt)
+            self.settles = self.settles + 1
+            self.condition.notify_all()
+
+    def cancel(self):
+        """Ends the current and any later waits, until reset() is called"""
+        with self.condition:
+            self.cancelled = True
+            self.condition.notify_all()
+
+    def reset(self):
+        with self.condition:
+            self.cancelled = False
+
+    def waiting(self, waiting):
+        if self.on_waiting is not None:
+            self.on_waiting(waiting)
+
+    def wait_for(self, reached, timeout=None, until_stopped=True):
+        """Waits until reached(pan, tilt) is True, returning True, or until the
+        positioner stops (if until_stopped), the wait is cancelled, or timeout
+        seconds pass (None waits indefinitely), returning False"""
+        self.waiting(True)
+        try:
+            return self._wait_for(reached, timeout, until_stopped)
+        finally:
+            self.waiting(False)
+
+    def _wait_for(self, reached, timeout, until_stopped):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            stops = self.stops
+            while True:
+                if reached(self.pan, self.tilt):
+                    return True
+                if self.cancelled or (until_stopped and self.stops != stops):
+                    return False
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+
+    def wait_settled(self, pan, tilt, since, timeout=None, tolerance=.01):
+        """Waits until a move to (pan, tilt) is reported settled, counting only
+        reports after the first since ones; take since from settles before
+        requesting the move. Returns True if it reached the target, False if it
+        settled elsewhere, None if the wait was cancelled or timed out"""
+        self.waiting(True)
+        try:
+            return self._wait_settled(pan, tilt, since, timeout, tolerance)
+        finally:
+            self.waiting(False)
+
+    def _wait_settled(self, pan, tilt, since, timeout, tolerance):
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            settles = since
+            while True:
+                if self.settles != settles:
+                    reached, target_pan, target_tilt = self.settled
+                    if abs(target_pan - pan) <= tolerance and abs(target_tilt - tilt) <= tolerance:
+                        return reached
+                    settles = self.settles # a previous move, keep waiting
+                if self.cancelled:
+                    return None
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return None
+                    self.condition.wait(remaining)
+"""End PositionMonitor Class"""
@@ -16,14 +16,17 @@
 # For any questions, contact Thomas at tomhoover1@gmail.com
 ################################################################################
 import time
+from collections import deque
 from threading import Lock
 
 import pyvisa as visa
 
 import measurement_ctrl.integer as qi
 import measurement_ctrl.packet as pkt
+from measurement_ctrl.codec import FrameDecoder
+from measurement_ctrl.constants import CMD
 from measurement_ctrl.constants import BIT0, BIT1, BIT2, BIT3, BIT4, BIT5, BIT6, BIT7
-from measurement_ctrl.packet_parser import Parser
+from measurement_ctrl.packet_parser import Parser, StatusState
 
 from PyQt5 import QtCore as qtc
 
@@ -34,6 +37,10 @@ class CommsSignals(qtc.QObject):
 
 class Comms:
     _LIMIT = 25
+    _REPLY_TIMEOUT = .1 # longest wait for the reply to a query, in seconds
+    _MIN_REPLY_TIMEOUT = .05 # shortest adaptive reply deadline, above the worst case serial turnaround
+    _LATENCY_SAMPLES = 200 # round trip times kept per command
+    _LATENCY_MIN_SAMPLES = 10 # samples needed before the deadline adapts
 
 
     def __init__(self, com_port, baud_rate):
@@ -46,6 +53,12 @@ class Comms:
         self.comms.stop_bites = visa.constants.StopBits.one
         self.comms.parity = visa.constants.Parity.none
         self.comms.data_bits = 8
+        self.decoder = FrameDecoder()
+        self.latency = {} # command byte -> deque of recent round trip times (s)
+        self.timeouts = {} # command byte -> number of queries without a reply
+        self.total_time = {} # command byte -> total seconds spent in queries
+        self.deadlines = {} # command byte -> current adaptive reply deadline (s)
+        self.stale_until = 0.0 # end of the reply window of the last query that timed out
         self.connected = self.init_comms_link()
 
 
@@ -61,13 +74,95 @@ class Comms:
 
 
     def positioner_query(self, msg):
-        self.comms.write_raw(msg)
+        """Sends msg and returns the first valid reply frame with the same command
+        byte, or None if none arrives before the reply deadline of the command.
+        Reads return as soon as an ETX arrives. Input received before msg is sent
+        is discarded, so the reply to an earlier query is never returned. The
+        round trip time is recorded for latency_stats."""
+        cmd = msg[1]
+        timeout = self.comms.timeout
         try:
-            time.sleep(.02)
-            rx = self.comms.read_raw()
-        except visa.errors.VisaIOError as err:
-            return None
-        return rx
+            self.discard_input()
+            start = time.perf_counter()
+            self.comms.write_raw(msg)
+            deadline = start + self.deadlines.get(cmd, self._REPLY_TIMEOUT)
+            while True:
+                remaining = deadline - time.perf_counter()
+                # Do not let a single read block past the deadline
+                self.comms.timeout = max(1, min(timeout, int(remaining * 1000)))
+                try:
+                    chunk = self.comms.read_raw()
+                except visa.errors.VisaIOError as err:
+                    chunk = b''
+                for frame in self.decoder.feed(chunk):
+                    if frame[1] == cmd:
+                        self.record_latency(cmd, time.perf_counter() - start)
+                        return frame
+                if time.perf_counter() >= deadline:
+                    self.record_timeout(cmd, time.perf_counter() - start)
+                    # The reply may still arrive, and replies only carry the command byte
+                    self.stale_until = start + self._REPLY_TIMEOUT
+                    return None
+        finally:
+            # Leave the timeout clear_rx_buffer and other readers expect
+            self.comms.timeout = timeout
+
+
+    def discard_input(self):
+        """Drops everything received so far. If the last query timed out before
+        its full reply window passed, first waits out the rest of the window,
+        discarding what arrives, since its late reply would match a later query
+        with the same command byte (status and jog replies are both 0x31)."""
+        remaining = self.stale_until - time.perf_counter()
+        while remaining > 0:
+            self.comms.timeout = max(1, int(remaining * 1000))
+            try:
+                self.comms.read_raw()
+            except visa.errors.VisaIOError as err:
+                pass
+            remaining = self.stale_until - time.perf_counter()
+        self.comms.flush(visa.constants.VI_READ_BUF_DISCARD | visa.constants.VI_IO_IN_BUF_DISCARD)
+        self.decoder.clear()
+
+
+    def record_latency(self, cmd, rtt):
+        samples = self.latency.get(cmd)
+        if samples is None:
+            samples = self.latency[cmd] = deque(maxlen=self._LATENCY_SAMPLES)
+        samples.append(rtt)
+        self.total_time[cmd] = self.total_time.get(cmd, 0.0) + rtt
+        if len(samples) >= self._LATENCY_MIN_SAMPLES:
+            # Wait up to three times the 95th percentile, within the fixed bounds
+            p95 = percentile(sorted(samples), .95)
+            self.deadlines[cmd] = min(self._REPLY_TIMEOUT, max(self._MIN_REPLY_TIMEOUT, 3 * p95))
+
+
+    def record_timeout(self, cmd, elapsed):
+        self.timeouts[cmd] = self.timeouts.get(cmd, 0) + 1
+        self.total_time[cmd] = self.total_time.get(cmd, 0.0) + elapsed
+        # The deadline may have adapted too far, so fall back to the full wait
+        self.deadlines.pop(cmd, None)
+
+
+    def latency_stats(self):
+        """Returns the round trip statistics of every command queried so far, keyed
+        by command name. Times are in seconds; 'total' includes timed out queries."""
+        names = {int.from_bytes(v, 'little'): k for k, v in CMD.items()}
+        stats = {}
+        for cmd in set(self.latency) | set(self.timeouts):
+            samples = sorted(self.latency.get(cmd, ()))
+            stats[names.get(cmd, hex(cmd))] = {
+                'count'    : len(samples),
+                'timeouts' : self.timeouts.get(cmd, 0),
+                'mean'     : sum(samples) / len(samples) if samples else None,
+                'p50'      : percentile(samples, .50),
+                'p90'      : percentile(samples, .90),
+                'p99'      : percentile(samples, .99),
+                'max'      : samples[-1] if samples else None,
+                'total'    : self.total_time.get(cmd, 0.0),
+                'deadline' : self.deadlines.get(cmd, self._REPLY_TIMEOUT),
+            }
+        return stats
 
 
     def clear_rx_buffer(self):
@@ -77,9 +172,17 @@ class Comms:
                 rx = self.comms.read_raw()
             except visa.errors.VisaIOError as err:
                 clear = True
+        self.decoder.clear()
 """End Comms Class"""
 
 
+def percentile(samples, p):
+    """Nearest rank percentile of sorted samples, or None if there are none"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+
 class QPTState:
     def __init__(self):
         self.model = {
@@ -140,24 +243,99 @@ class PositionerSignals(qtc.QObject):
     currentTilt = qtc.pyqtSignal(str)
     softFault   = qtc.pyqtSignal(tuple)
     hardFault   = qtc.pyqtSignal(tuple)
+    settled     = qtc.pyqtSignal(bool, float, float) # reached, target pan, target tilt
+
+
+class SettleDetector:
+    """Decides when an automated move is over from successive status frames.
+
+    A move has settled on its target once settle_frames consecutive frames
+    report the positioner neither executing a move nor moving either axis,
+    with both angles within tolerance of the target. Counting frames instead
+    of comparing the angles between frames keeps a one count (0.01 deg)
+    jitter at fast polling from reading as motion. Crossing the target while
+    moving, e.g. on overshoot, does not count. A move ends without reaching
+    the target when the positioner sits still for quiet_frames frames away
+    from the target, e.g. on a soft limit, or when the distance to the target
+    has not shrunk for stall_time seconds, so a slow axis is waited on for as
+    long as it makes progress. The still frames rule only applies grace_time
+    seconds after the move started, since the executing and moving bits may
+    only show up a few frames after the move command.
+
+    tolerance (deg) defaults to five counts of the positioner resolution, and
+    can be set per move, e.g. from the resolution of a sweep.
+    """
+    RESOLUTION = .01 # deg per count of the reported angles
+
+    def __init__(self, tolerance=5 * RESOLUTION, settle_frames=2, quiet_frames=2, stall_time=3.0,
+                 grace_time=.5):
+        self.tolerance = tolerance
+        self.settle_frames = settle_frames
+        self.quiet_frames = quiet_frames
+        self.stall_time = stall_time
+        self.grace_time = grace_time
+        self.target = None # (pan, tilt) of the move being watched, None when idle
+
+    def start(self, pan, tilt, now, tolerance=None):
+        """Watches a move to (pan, tilt), within tolerance or the default one"""
+        self.target = (pan, tilt)
+        self.move_tolerance = self.tolerance if tolerance is None else max(tolerance, self.RESOLUTION)
+        self.start_time = now
+        self.still = 0 # consecutive frames within tolerance and not moving
+        self.quiet = 0 # consecutive frames away from the target and not moving
+        self.best = None # smallest distance to the target so far
+        self.progress_time = now
+
+    def cancel(self):
+        self.target = None
+
+    def update(self, now, pan, tilt, moving):
+        """Feeds one status frame. Returns None while the move is going on (or no
+        move is watched), else True if it settled on target, False if it did not"""
+        if self.target is None:
+            return None
+        distance = max(abs(pan - self.target[0]), abs(tilt - self.target[1]))
+        if self.best is None or distance < self.best - self.move_tolerance:
+            self.best = distance
+            self.progress_time = now
+
+        result = None
+        on_target = distance <= self.move_tolerance
+        self.still = self.still + 1 if not moving and on_target else 0
+        self.quiet = self.quiet + 1 if not moving and not on_target else 0
+        if self.still >= self.settle_frames:
+            result = True
+        elif self.quiet >= self.quiet_frames and now - self.start_time >= self.grace_time:
+            result = False
+        elif now - self.progress_time >= self.stall_time:
+            result = False
+        if result is not None:
+            self.target = None
+        return result
+"""End SettleDetector Class"""
+
+
+def status_flag(name):
+    """Read only property decoding one status flag from the raw status bytes"""
+    return property(lambda self: self.status_state.flag(name))
 
 
 class Positioner:
-    def __init__(self, com_port, baud_rate):
+    def __init__(self, com_port, baud_rate, telemetry=None):
         self.comms = Comms(com_port, baud_rate)
         self.p = Parser()
+        self.telemetry = telemetry # TelemetryBuffer the parser records status frames in
         self.curr_lock = Lock()
+        self.status_state = StatusState() # raw status bytes, see the flags below
+        self.changed = True # set by the parser, cleared by whoever publishes the state
+        self.settle = SettleDetector() # watches automated moves until they settle
 
         # General Properties
-        self.status_executing = False
         self.comms_timeout = False
         self.curr_position = qi.Coordinate(0,0)
         self.dest_position = qi.Coordinate(0,0)
         self.pan_center_RU = 0
         self.tilt_center_RU = 0
-        self.status_high_res = True
-        self.status_dest_coords = False
-        self.status_soft_limit_override = False
         self.angle_corrections = qi.Coordinate(0,0)
 
         # Pan Properties
@@ -165,36 +343,12 @@ class Positioner:
         self.pan_max_speed = 0
         self.pan_cw_soft_limit = 0
         self.pan_ccw_soft_limit = 0
-        self.pan_status_cw_moving = False
-        self.pan_status_ccw_moving = False
-
-        # Pan Status
-        self.sfault_cw_soft_limit = False
-        self.sfault_ccw_soft_limit = False
-        self.hfault_cw_hard_limit = False
-        self.hfault_ccw_hard_limit = False
-        self.hfault_pan_timeout = False
-        self.hfault_pan_direction_error = False
-        self.hfault_pan_current_overload = False
-        self.sfault_pan_resolver_fault = False
 
         # Tilt Properties
         self.tilt_min_speed = 0
         self.tilt_max_speed = 0
         self.tilt_up_soft_limit = 0
         self.tilt_down_soft_limit = 0
-        self.tilt_status_up_moving = False
-        self.tilt_status_down_moving = False
-
-        # Tilt Status
-        self.sfault_up_soft_limit = False
-        self.sfault_down_soft_limit = False
-        self.hfault_up_hard_limit = False
-        self.hfault_down_hard_limit = False
-        self.hfault_tilt_timeout = False
-        self.hfault_tilt_direction_error = False
-        self.hfault_tilt_current_overload = False
-        self.sfault_tilt_resolver_fault = False
 
         # Initialize positioner signals, properties and status
         self.signals = PositionerSignals()
@@ -210,23 +364,81 @@ class Positioner:
         self.MAX_TILT_SPEED = 127
 
 
-    def move_to(self, pan, tilt, move_type='stop'):
+    # Status flags, decoded from the last status frame when read
+    # General Status
+    status_executing           = status_flag('status_executing')
+    status_high_res            = status_flag('status_high_res')
+    status_dest_coords         = status_flag('status_dest_coords')
+    status_soft_limit_override = status_flag('status_soft_limit_override')
+
+    # Pan Status
+    pan_status_cw_moving        = status_flag('pan_status_cw_moving')
+    pan_status_ccw_moving       = status_flag('pan_status_ccw_moving')
+    sfault_cw_soft_limit        = status_flag('sfault_cw_soft_limit')
+    sfault_ccw_soft_limit       = status_flag('sfault_ccw_soft_limit')
+    hfault_cw_hard_limit        = status_flag('hfault_cw_hard_limit')
+    hfault_ccw_hard_limit       = status_flag('hfault_ccw_hard_limit')
+    hfault_pan_timeout          = status_flag('hfault_pan_timeout')
+    hfault_pan_direction_error  = status_flag('hfault_pan_direction_error')
+    hfault_pan_current_overload = status_flag('hfault_pan_current_overload')
+    sfault_pan_resolver_fault   = status_flag('sfault_pan_resolver_fault')
+
+    # Tilt Status
+    tilt_status_up_moving        = status_flag('tilt_status_up_moving')
+    tilt_status_down_moving      = status_flag('tilt_status_down_moving')
+    sfault_up_soft_limit         = status_flag('sfault_up_soft_limit')
+    sfault_down_soft_limit       = status_flag('sfault_down_soft_limit')
+    hfault_up_hard_limit         = status_flag('hfault_up_hard_limit')
+    hfault_down_hard_limit       = status_flag('hfault_down_hard_limit')
+    hfault_tilt_timeout          = status_flag('hfault_tilt_timeout')
+    hfault_tilt_direction_error  = status_flag('hfault_tilt_direction_error')
+    hfault_tilt_current_overload = status_flag('hfault_tilt_current_overload')
+    sfault_tilt_resolver_fault   = status_flag('sfault_tilt_resolver_fault')
+
+
+    def move_to(self, pan, tilt, move_type='stop', tolerance=None):
         # Set min speed high enough the motors wont timeout while stopping
-        self.p.parse(self.comms.positioner_query(pkt.set_minimum_speeds(50,50)),self)
+        self.set_minimum_speeds(50, 50)
 
-        # Issue the appropriate movement command
+        # Issue the appropriate movement command, and watch it until it settles
+        # within tolerance (the settle detector's default if None)
+        now = time.monotonic()
         if move_type == 'abs':
             coord = qi.Coordinate(pan,tilt)
+            self.settle.start(coord.pan_angle(), coord.tilt_angle(), now, tolerance)
             self.p.parse(self.comms.positioner_query(pkt.move_to_entered_coords(coord)),self)
         elif move_type == 'delta':
             coord = qi.Coordinate(pan,tilt)
+            self.settle.start(self.curr_position.pan_angle() + coord.pan_angle(),
+                              self.curr_position.tilt_angle() + coord.tilt_angle(), now, tolerance)
             self.p.parse(self.comms.positioner_query(pkt.move_to_delta_coords(coord)),self)
         elif move_type == 'zero':
+            self.settle.start(0.0, 0.0, now, tolerance)
             self.p.parse(self.comms.positioner_query(pkt.move_to_absolute_zero()),self)
         else:
+            self.settle.cancel()
             self.p.parse(self.comms.positioner_query(pkt.stop()),self)
 
 
+    def set_minimum_speeds(self, pan_speed, tilt_speed):
+        """Sets the minimum speeds, unless the positioner already reported them.
+        pan_min_speed and tilt_min_speed only change with the positioner's replies,
+        so they are cleared when a reply does not arrive and the setting is unknown"""
+        if self.pan_min_speed == pan_speed and self.tilt_min_speed == tilt_speed:
+            return
+        rx = self.comms.positioner_query(pkt.set_minimum_speeds(pan_speed, tilt_speed))
+        if rx is None:
+            self.pan_min_speed = None
+            self.tilt_min_speed = None
+        else:
+            self.p.parse(rx, self)
+
+
+    def is_moving(self):
+        """True while a move is executing or either axis reports moving"""
+        return self.status_executing or bool(self.status_state.status[2] & (BIT3 | BIT2 | BIT1 | BIT0))
+
+
     def get_position(self):
         with self.curr_lock:
             curr = self.curr_position
@@ -235,6 +447,18 @@ class Positioner:
 
     def get_status(self):
         self.p.parse(self.comms.positioner_query(pkt.get_status()), self)
+        self.check_settled()
+
+
+    def check_settled(self):
+        """Feeds the last status to the settle detector, emitting settled once
+        the watched move is over"""
+        target = self.settle.target
+        with self.curr_lock:
+            curr = self.curr_position
+        result = self.settle.update(time.monotonic(), curr.pan_angle(), curr.tilt_angle(), self.is_moving())
+        if result is not None:
+            self.signals.settled.emit(result, target[0], target[1])
 
 
     def clear_offsets(self):
@@ -246,7 +470,7 @@ class Positioner:
 
 
     def jog_cw(self, pan_speed, target):
-        self.p.parse(self.comms.positioner_query(pkt.set_minimum_speeds(8,17)),self)
+        self.set_minimum_speeds(8, 17)
         if self.curr_position.pan_angle() < target.pan_angle():
             rx = self.comms.positioner_query(pkt.jog_positioner(pan_speed, 1, 0, 0))
             self.p.parse(rx, self)
@@ -255,7 +479,7 @@ class Positioner:
 
 
     def jog_ccw(self, pan_speed, target):
-        self.p.parse(self.comms.positioner_query(pkt.set_minimum_speeds(8,17)),self)
+        self.set_minimum_speeds(8, 17)
         if self.curr_position.pan_angle() > target.pan_angle():
             rx = self.comms.positioner_query(pkt.jog_positioner(pan_speed, 0, 0, 0))
             self.p.parse(rx, self)
@@ -264,7 +488,7 @@ class Positioner:
 
 
     def jog_up(self, tilt_speed, target):
-        self.p.parse(self.comms.positioner_query(pkt.set_minimum_speeds(8,17)),self)
+        self.set_minimum_speeds(8, 17)
         if self.curr_position.tilt_angle() < target.tilt_angle():
             rx = self.comms.positioner_query(pkt.jog_positioner(0, 0, tilt_speed, 1))
             self.p.parse(rx, self)
@@ -273,7 +497,7 @@ class Positioner:
             
 
     def jog_down(self, tilt_speed, target):
-        self.p.parse(self.comms.positioner_query(pkt.set_minimum_speeds(8,17)),self)
+        self.set_minimum_speeds(8, 17)
         if self.curr_position.tilt_angle() > target.tilt_angle():
             rx = self.comms.positioner_query(pkt.jog_positioner(0, 0, tilt_speed, 0))
             self.p.parse(rx, self)
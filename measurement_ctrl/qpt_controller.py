@@ -17,103 +17,210 @@ from PyQt5 import QtCore as qtc
 
 from measurement_ctrl.positioner import Positioner
 from measurement_ctrl.integer import Coordinate
+from measurement_ctrl.telemetry import TelemetryBuffer
 
-from queue import PriorityQueue, Empty, Full
+from queue import Empty
+from collections import deque
+from threading import Condition
 from dataclasses import dataclass, field
 from typing import Any
 import time
 import traceback, sys
 
-@dataclass(order=True)
-class QPTMessage:
-    """Wrapper for message to be transmitted by the positioner to support
-    using a PriorityQueue to synchronize communicates between the 
-    main thread/measurement control thread and the positioner control thread
-    """ 
-    priority: int
-    item: Any=field(compare=False)
+@dataclass
+class QPTCommand:
+    """Command for the positioner thread. kind is one of the names in
+    QPTMessageQueue.AXES, PREEMPT or CONFIG, 'MoveTo', or 'GetStatus' for the
+    polls QPTMaster makes when there is no command. Jogs come from the
+    settings window buttons (source 'sw') or from measurement control ('mc',
+    with a speed and target Coordinate); moves carry pan, tilt, move_type and
+    tolerance as for Positioner.move_to
+    """
+    kind: str
+    source: str = 'sw'
+    speed: int = 0
+    target: Any = None
+    pan: float = 0.0
+    tilt: float = 0.0
+    move_type: str = 'abs'
+    tolerance: Any = None
+    seq: int = field(default=0, compare=False) # order the command was posted in
 
 
 class QPTMessageQueue(qtc.QObject):
+    """Mailbox of commands for the positioner thread, which collapses commands
+    that a newer one supersedes, so the thread never works through a backlog
+    of stale commands:
+        - Stop and FaultReset preempt everything else, and Stop drops all
+          other pending commands, like the queue clear it used to trigger
+        - only the latest jog per axis is kept
+        - only the latest move is kept
+        - configuration commands are kept in order
+    Jogs and moves are taken in the order they were posted. Every access holds
+    one lock, so posting, taking and clearing are atomic.
+    """
+    AXES = {'JogCW': 'pan', 'JogCCW': 'pan', 'JogUp': 'tilt', 'JogDown': 'tilt'}
+    PREEMPT = ('Stop', 'FaultReset')
+    CONFIG = ('ZeroOffsets', 'AlignToCenter')
+
     def __init__(self):
         super().__init__()
-        self.q = PriorityQueue()
+        self.cond = Condition()
+        self.preempt = [] # Stop first, then FaultReset
+        self.jogs = {} # axis -> latest jog
+        self.move = None
+        self.config = deque()
+        self.seq = 0
+        self.posted = 0 # commands posted
+        self.dropped = 0 # commands superseded or cleared before being sent
         self.qpt_connected = False
 
     def ready4msg(self):
-        if self.qpt_connected and not self.q.full():
-            return True
-        return False
+        return self.qpt_connected
+
+    def depth(self):
+        with self.cond:
+            return self.pending()
+
+    def pending(self):
+        return len(self.preempt) + len(self.jogs) + (self.move is not None) + len(self.config)
+
+    def stats(self):
+        with self.cond:
+            return {'depth': self.pending(), 'posted': self.posted, 'dropped': self.dropped}
+
+    def post(self, cmd):
+        with self.cond:
+            self.seq = self.seq + 1
+            self.posted = self.posted + 1
+            cmd.seq = self.seq
+            if cmd.kind in self.PREEMPT:
+                if cmd.kind == 'Stop':
+                    self.drop_pending(keep_preempt=True)
+                if any(c.kind == cmd.kind for c in self.preempt):
+                    self.dropped = self.dropped + 1
+                else:
+                    self.preempt.append(cmd)
+                    self.preempt.sort(key=lambda c: self.PREEMPT.index(c.kind))
+            elif cmd.kind in self.AXES:
+                if self.jogs.get(self.AXES[cmd.kind]) is not None:
+                    self.dropped = self.dropped + 1
+                self.jogs[self.AXES[cmd.kind]] = cmd
+            elif cmd.kind == 'MoveTo':
+                if self.move is not None:
+                    self.dropped = self.dropped + 1
+                self.move = cmd
+            else:
+                self.config.append(cmd)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Takes the next command, waiting up to timeout seconds for one.
+        Raises queue.Empty if there is none"""
+        with self.cond:
+            if self.pending() == 0:
+                self.cond.wait(timeout)
+            if self.preempt:
+                return self.preempt.pop(0)
+            motion = list(self.jogs.values())
+            if self.move is not None:
+                motion.append(self.move)
+            if motion:
+                cmd = min(motion, key=lambda c: c.seq)
+                if cmd is self.move:
+                    self.move = None
+                else:
+                    del self.jogs[self.AXES[cmd.kind]]
+                return cmd
+            if self.config:
+                return self.config.popleft()
+            raise Empty
+
+    def drop_pending(self, keep_preempt=False):
+        dropped = self.pending() - (len(self.preempt) if keep_preempt else 0)
+        self.dropped = self.dropped + dropped
+        if not keep_preempt:
+            self.preempt = []
+        self.jogs = {}
+        self.move = None
+        self.config.clear()
+
+    def clear(self):
+        """Drops every pending command"""
+        with self.cond:
+            self.drop_pending()
 
+    @qtc.pyqtSlot()
     def clear_Q(self):
-        del self.q
-        self.q = PriorityQueue()
+        self.clear()
 
     @qtc.pyqtSlot(list)
     def q_jog_cw_list(self, args):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogCW', args[0], args[1], args[2]]))
+            self.post(QPTCommand('JogCW', args[0], args[1], args[2]))
 
     @qtc.pyqtSlot(bool)
     def q_jog_cw(self, bool_val):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogCW', 'sw']))
+            self.post(QPTCommand('JogCW'))
 
     @qtc.pyqtSlot(list)
     def q_jog_ccw_list(self, args):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogCCW', args[0], args[1], args[2]]))
+            self.post(QPTCommand('JogCCW', args[0], args[1], args[2]))
 
     @qtc.pyqtSlot(bool)
     def q_jog_ccw(self, bool_val):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogCCW', 'sw']))
+            self.post(QPTCommand('JogCCW'))
 
     @qtc.pyqtSlot(list)
     def q_jog_up_list(self, args):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogUp', args[0], args[1], args[2]]))
+            self.post(QPTCommand('JogUp', args[0], args[1], args[2]))
 
     @qtc.pyqtSlot(bool)
     def q_jog_up(self, bool_val):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogUp', 'sw']))
+            self.post(QPTCommand('JogUp'))
 
     @qtc.pyqtSlot(list)
     def q_jog_down_list(self, args):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogDown', args[0], args[1], args[2]]))
+            self.post(QPTCommand('JogDown', args[0], args[1], args[2]))
 
     @qtc.pyqtSlot(bool)
     def q_jog_down(self, bool_val):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['JogDown', 'sw']))
+            self.post(QPTCommand('JogDown'))
 
     @qtc.pyqtSlot()
     def q_stop(self):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(0, ['Stop']))
+            self.post(QPTCommand('Stop'))
 
 
     @qtc.pyqtSlot(list)
     def q_move_to(self, args):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(1, ['MoveTo', args[0], args[1], args[2]]))
+            tolerance = args[3] if len(args) > 3 else None
+            self.post(QPTCommand('MoveTo', pan=args[0], tilt=args[1], move_type=args[2],
+                                 tolerance=tolerance))
 
     @qtc.pyqtSlot()
     def q_zero_offsets(self):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(2, ['ZeroOffsets']))
+            self.post(QPTCommand('ZeroOffsets'))
 
     @qtc.pyqtSlot()
     def q_align_to_center(self):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(2, ['AlignToCenter']))
+            self.post(QPTCommand('AlignToCenter'))
 
     @qtc.pyqtSlot()
     def q_fault_reset(self, things):
         if self.ready4msg():
-            self.q.put_nowait(QPTMessage(0, ['FaultReset']))
+            self.post(QPTCommand('FaultReset'))
 
 """End QPTMessageQueue"""
 
@@ -129,9 +236,18 @@ class QPTMasterSignals(qtc.QObject):
     currentTilt = qtc.pyqtSignal(str)
     fPan = qtc.pyqtSignal(float)
     fTilt = qtc.pyqtSignal(float)
+    moving = qtc.pyqtSignal(bool)
+    settled = qtc.pyqtSignal(bool, float, float)
+    pollRate = qtc.pyqtSignal(float)
 
 
 class QPTMaster(qtc.QThread):
+    HEARTBEAT = 1.0 # seconds between position updates while nothing changes
+    FAST_PERIOD = .01 # poll period in motion, the serial round trip adds to it
+    IDLE_PERIOD = 1.0 # poll period while idle, shortened to fit the comms timeout
+    LINGER = .5 # seconds polling stays fast after a move or jog is requested
+    MOTION_MSGS = ('JogCW', 'JogCCW', 'JogUp', 'JogDown', 'MoveTo') # command kinds that start motion
+
     def __init__(self, parent):
         super().__init__()
         self.parent = parent
@@ -142,6 +258,10 @@ class QPTMaster(qtc.QThread):
         self.m_connected = False
         self.Q = QPTMessageQueue()
         self.signals = QPTMasterSignals()
+        self.telemetry = TelemetryBuffer() # position history, readable from any thread
+        self.m_waiting = False # a measurement is waiting on the position
+        self.last_motion = None # monotonic time of the last move or jog request
+        self.poll_rate = 0.0 # transactions per second with the positioner, updated each HEARTBEAT
 
 
     def run(self):
@@ -155,7 +275,7 @@ class QPTMaster(qtc.QThread):
         # error, catch the exception and emit the error back to the gui and
         # then exit the thread, else, emit connected signal
         try:
-            qpt = Positioner(currentPortName, currentBaudRate)
+            qpt = Positioner(currentPortName, currentBaudRate, self.telemetry)
             self.msleep(500)
             if qpt.comms.connected is not True:
                 self.Q.qpt_connected = False
@@ -167,83 +287,106 @@ class QPTMaster(qtc.QThread):
             self.signals.error.emit((exctype, value, traceback.format_exc()))
             return None
         else:
+            qpt.signals.settled.connect(self.signals.settled.emit)
             self.signals.connected.emit()
             self.m_connected = True
             self.Q.qpt_connected = True
 
+        # position signals are only emitted when the positioner state changed,
+        # or once every HEARTBEAT seconds while it is idle
+        last_emit = None
+
+        # poll rate statistic, counted over each HEARTBEAT
+        polls = 0
+        rate_start = time.monotonic()
+        next_poll = rate_start
+
         # main communications loop with the positioner
-        # sends a msg with the positioner ever 120ms, some slight variation
-        # in the period for transmission is acceptable, so msleep is used
-        # to yield thread until next transmission
+        # queued messages are sent as soon as they arrive, and the status is
+        # polled at the period poll_period() picks for the positioner's state:
+        # fast while it moves or a measurement waits on it, slow while idle
         while not self.m_quit:
-            # Check if message queue has any items in it, if not, catch the
-            # Empty exception and send a query to get the current status of
-            # the positioner
+            # Wait for a command until the next poll is due, if none arrives,
+            # catch the Empty exception and send a query to get the current
+            # status of the positioner
             try:
-                msg = self.Q.q.get_nowait()
+                cmd = self.Q.get(timeout=max(0.0, next_poll - time.monotonic()))
             except Empty as e:
-                msg = ['GetStatus']
+                cmd = QPTCommand('GetStatus')
             else:
-                msg = msg.item
+                if cmd.kind in self.MOTION_MSGS:
+                    self.last_motion = time.monotonic()
 
-            # Decode the message to send to the positioner then trigger
+            # Decode the command to send to the positioner then trigger
             # the packet transmission
-            if msg[0] == 'Stop':
+            if cmd.kind == 'Stop':
                 qpt.move_to(0,0,'stop')
-                self.Q.clear_Q()
+                self.Q.clear()
 
-            elif msg[0] == 'FaultReset':
+            elif cmd.kind == 'FaultReset':
                 qpt.clear_faults()
 
-            elif msg[0] == 'GetStatus':
+            elif cmd.kind == 'GetStatus':
                 qpt.get_status()
             
-            elif msg[0] == 'JogCW':
-                if msg[1] == 'sw':
+            elif cmd.kind == 'JogCW':
+                if cmd.source == 'sw':
                     qpt.jog_cw(30, Coordinate(180,0))
                     if self.parent.settings.right_toolButton_4.isDown() is not True:
-                        self.Q.clear_Q()
+                        self.Q.clear()
                 else:
-                    qpt.jog_cw(msg[2], msg[3])
+                    qpt.jog_cw(cmd.speed, cmd.target)
 
-            elif msg[0] == 'JogCCW':
-                if msg[1] == 'sw':
+            elif cmd.kind == 'JogCCW':
+                if cmd.source == 'sw':
                     qpt.jog_ccw(30, Coordinate(-180,0))
                     if self.parent.settings.left_toolButton_4.isDown() is not True:
-                        self.Q.clear_Q()
+                        self.Q.clear()
                 else:
-                    qpt.jog_ccw(msg[2], msg[3])
+                    qpt.jog_ccw(cmd.speed, cmd.target)
 
-            elif msg[0] == 'JogUp':
-                if msg[1] == 'sw':
+            elif cmd.kind == 'JogUp':
+                if cmd.source == 'sw':
                     qpt.jog_up(30, Coordinate(0, 90))
                     if self.parent.settings.up_toolButton_4.isDown() is not True:
-                        self.Q.clear_Q()                    
+                        self.Q.clear()
                 else:
-                    qpt.jog_up(msg[2], msg[3])
+                    qpt.jog_up(cmd.speed, cmd.target)
 
-            elif msg[0] == 'JogDown':
-                if msg[1] == 'sw':
+            elif cmd.kind == 'JogDown':
+                if cmd.source == 'sw':
                     qpt.jog_down(30, Coordinate(0, -90))
                     if self.parent.settings.down_toolButton_4.isDown() is not True:
-                        self.Q.clear_Q()                    
+                        self.Q.clear()
                 else:
-                    qpt.jog_down(msg[2], msg[3])
+                    qpt.jog_down(cmd.speed, cmd.target)
 
-            elif msg[0] == 'MoveTo':
-                qpt.move_to(msg[1], msg[2], msg[3])
+            elif cmd.kind == 'MoveTo':
+                qpt.move_to(cmd.pan, cmd.tilt, cmd.move_type, cmd.tolerance)
 
-            elif msg[0] == 'ZeroOffsets':
+            elif cmd.kind == 'ZeroOffsets':
                 qpt.clear_offsets()
 
-            elif msg[0] == 'AlignToCenter':
+            elif cmd.kind == 'AlignToCenter':
                 qpt.align_to_center()
 
-            self.signals.currentPan.emit('{:0.2f}'.format(qpt.curr_position.pan_angle()))
-            self.signals.fPan.emit(qpt.curr_position.pan_angle())
-            self.signals.currentTilt.emit('{:0.2f}'.format(qpt.curr_position.tilt_angle()))
-            self.signals.fTilt.emit(qpt.curr_position.tilt_angle())
-            self.msleep(120)
+            now = time.monotonic()
+            if qpt.changed or last_emit is None or now - last_emit >= self.HEARTBEAT:
+                qpt.changed = False
+                last_emit = now
+                self.signals.currentPan.emit('{:0.2f}'.format(qpt.curr_position.pan_angle()))
+                self.signals.fPan.emit(qpt.curr_position.pan_angle())
+                self.signals.currentTilt.emit('{:0.2f}'.format(qpt.curr_position.tilt_angle()))
+                self.signals.fTilt.emit(qpt.curr_position.tilt_angle())
+                self.signals.moving.emit(qpt.is_moving())
+
+            polls = polls + 1
+            if now - rate_start >= self.HEARTBEAT:
+                self.poll_rate = polls / (now - rate_start)
+                self.signals.pollRate.emit(self.poll_rate)
+                polls = 0
+                rate_start = now
+            next_poll = now + self.poll_period(qpt, now)
             # end comms loop, breaks if self.m_quit is True
 
         qpt.move_to(0,0,'stop')
@@ -252,6 +395,24 @@ class QPTMaster(qtc.QThread):
         self.Q.qpt_connected = False
 
 
+    def poll_period(self, qpt, now):
+        """Seconds until the next status poll. Polling is fast while the
+        positioner moves or settles, a move or jog was just requested, or a
+        measurement waits on the position. Otherwise it is a heartbeat, kept
+        under half the comms timeout so the QPT's watchdog does not trip"""
+        if (qpt.is_moving() or qpt.settle.target is not None or self.m_waiting
+                or (self.last_motion is not None and now - self.last_motion < self.LINGER)):
+            return self.FAST_PERIOD
+        if qpt.comms_timeout:
+            return min(self.IDLE_PERIOD, qpt.comms_timeout / 2)
+        return self.IDLE_PERIOD
+
+
+    @qtc.pyqtSlot(bool)
+    def set_waiting(self, waiting):
+        self.m_waiting = waiting
+
+
     def init_connection(self, portName, baudRate):
         locker = qtc.QMutexLocker(self.m_mutex)
         self.m_portName = portName
@@ -0,0 +1,402 @@
+################################################################################
+# qpt_simulator
+# Description:
+#   Virtual QPT-130 positioner speaking the PTHR-90 protocol, so the
+#   positioner comms, the QPTMaster polling loop, jogs and move waits can be
+#   run without hardware. The VirtualQPT parses the STX/ESC/LRC framed
+#   packets built by packet.py, models the pan and tilt axes moving at the
+#   speeds requested by jog and move packets, enforces soft limits, reports
+#   soft and hard fault bits, and replies with frames Parser accepts.
+#
+#   It can be used two ways:
+#     1. Over a pseudo-terminal: start() opens a pty and serves it from a
+#        thread, and port/resource give the names to open it with, e.g.
+#        Positioner(qpt.resource, 9600).
+#     2. In process: exchange(packet) returns the reply to a packet directly.
+#        With an injected clock this makes whole sweeps deterministic.
+#
+#   Simulator assumptions, where the protocol leaves the behaviour open:
+#     - A jog keeps an axis moving for jog_timeout seconds; repeating the jog
+#       packet extends it, like holding a joystick. A Get Status packet (jog
+#       speeds of zero) does not stop a jog.
+#     - Automated moves run at the maximum speeds and stop exactly on target.
+#     - Speeds convert to deg/s with the same fits MeasurementCtrl uses:
+#       pan (speed - 3.1546) / 12.8866, tilt (speed - 6.8228) / 39.3701.
+#
+#   Running this module serves a virtual positioner on a pty until Ctrl-C:
+#       python -m measurement_ctrl.qpt_simulator
+#
+# Dependencies: n/a (POSIX pseudo-terminals for start())
+#
+# Built with Python Version: 3.8.5
+################################################################################
+import os
+import select
+import time
+from threading import Thread, Lock
+
+import measurement_ctrl.codec as codec
+from measurement_ctrl.constants import CTRL
+from measurement_ctrl.constants import BIT0, BIT1, BIT2, BIT3, BIT4, BIT5, BIT6, BIT7
+
+
+STX = CTRL['STX'][0]
+ETX = CTRL['ETX'][0]
+LATCHING_FAULTS = BIT1 | BIT2 | BIT3  # Current overload, direction error, timeout
+STOPPING_FAULTS = LATCHING_FAULTS | BIT4 | BIT5  # Faults that keep an axis from moving
+
+
+class VirtualAxis:
+    """One axis of the virtual positioner. Positions are in degrees without
+    angle correction, positive is CW for pan and UP for tilt"""
+
+    def __init__(self, low_limit, high_limit, slope, offset, min_speed, max_speed):
+        self.position = 0.0
+        self.direction = 0  # +1, -1 or 0 when stopped
+        self.rate = 0.0  # deg/s
+        self.target = None  # Destination of an automated move
+        self.jog_deadline = None  # Clock time a jog stops unless repeated
+        self.low_limit = low_limit  # Soft limits
+        self.high_limit = high_limit
+        self.at_low_limit = False  # Soft fault flags
+        self.at_high_limit = False
+        self.faults = 0  # Hard fault bits, positioned like the status byte
+        self.slope = slope
+        self.offset = offset
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.center_RU = 0
+
+    def deg_per_s(self, speed):
+        speed = min(max(speed, self.min_speed), self.max_speed)
+        return max(0.0, (speed - self.offset) / self.slope)
+
+    def stop(self):
+        self.direction = 0
+        self.rate = 0.0
+        self.target = None
+        self.jog_deadline = None
+
+    def jog(self, speed, direction, deadline):
+        self.target = None
+        self.direction = 1 if direction else -1
+        self.rate = self.deg_per_s(speed)
+        self.jog_deadline = deadline
+        self.clear_limit_flag()
+
+    def move(self, target):
+        self.jog_deadline = None
+        self.target = target
+        if target > self.position:
+            self.direction = 1
+        elif target < self.position:
+            self.direction = -1
+        else:
+            self.stop()
+            return
+        self.rate = self.deg_per_s(self.max_speed)
+        self.clear_limit_flag()
+
+    def clear_limit_flag(self):
+        if self.direction > 0:
+            self.at_low_limit = False
+        elif self.direction < 0:
+            self.at_high_limit = False
+
+    def is_moving(self):
+        return self.direction != 0 and not self.faults & STOPPING_FAULTS
+
+    def advance(self, dt, override):
+        """Moves the axis for dt seconds. Returns True if an automated move arrived"""
+        if not self.is_moving() or dt <= 0:
+            return False
+        new = self.position + self.direction * self.rate * dt
+        arrived = False
+        if self.target is not None:
+            if (self.direction > 0 and new >= self.target) or (self.direction < 0 and new <= self.target):
+                new = self.target
+                arrived = True
+        if not override:
+            if new > self.high_limit:
+                new = self.high_limit
+                self.at_high_limit = True
+                arrived = False
+                self.stop()
+            elif new < self.low_limit:
+                new = self.low_limit
+                self.at_low_limit = True
+                arrived = False
+                self.stop()
+        self.position = new
+        if arrived:
+            self.stop()
+        return arrived
+
+    def status_byte(self):
+        status = self.faults
+        if self.at_high_limit:
+            status |= BIT7
+        if self.at_low_limit:
+            status |= BIT6
+        return status
+"""End VirtualAxis Class"""
+
+
+class VirtualQPT:
+    def __init__(self, clock=time.monotonic, jog_timeout=.5, reply_delay=.005):
+        """
+        :param clock: Function returning the current time in seconds; inject a
+                      fake clock to make runs deterministic
+        :param jog_timeout: Seconds a jog keeps moving without being repeated
+        :param reply_delay: Seconds before a reply is written to the pty
+        """
+        self.clock = clock
+        self.jog_timeout = jog_timeout
+        self.reply_delay = reply_delay
+        self.pan = VirtualAxis(-180.0, 180.0, 12.8866, 3.1546, 8, 127)
+        self.tilt = VirtualAxis(-90.0, 90.0, 39.3701, 6.8228, 17, 127)
+        self.pan_correction = 0.0  # Angle corrections, added to reported angles
+        self.tilt_correction = 0.0
+        self.soft_limit_override = False
+        self.dest_coords = False  # True once an automated move reached its destination
+        self.comms_timeout = 0  # Seconds without packets before stopping, 0 is off
+        self.last_update = clock()
+        self.last_rx = self.last_update
+        self.rx_buffer = bytearray()
+        self.frames = 0  # Number of valid frames received
+        self.lock = Lock()
+        self.master = None
+        self.slave = None
+        self.port = None  # pty device path once started
+        self.running = False
+        self.thread = None
+
+    # ------------------------------ Kinematics ------------------------------
+    def update(self):
+        """Advances both axes to the current clock time"""
+        now = self.clock()
+        if self.comms_timeout and now - self.last_rx > self.comms_timeout:
+            # Comms watchdog: advance to the timeout, then stop everything
+            self.advance(self.last_rx + self.comms_timeout)
+            self.pan.stop()
+            self.tilt.stop()
+        self.advance(now)
+
+    def advance(self, now):
+        for axis in (self.pan, self.tilt):
+            start = self.last_update
+            if axis.jog_deadline is not None and axis.jog_deadline < now:
+                arrived = axis.advance(axis.jog_deadline - start, self.soft_limit_override)
+                axis.stop()
+            else:
+                arrived = axis.advance(now - start, self.soft_limit_override)
+            if arrived and self.pan.target is None and self.tilt.target is None:
+                self.dest_coords = True
+        self.last_update = max(self.last_update, now)
+
+    def executing(self):
+        return self.pan.target is not None or self.tilt.target is not None
+
+    def inject_fault(self, axis, bit):
+        """Sets a fault bit (BIT0-BIT5 of the axis status byte) on 'pan' or 'tilt'.
+        Latching faults stop the axis until a fault reset"""
+        self.update()
+        getattr(self, axis).faults |= bit
+
+    def reported(self):
+        """Returns the reported (pan, tilt) in degrees, including angle corrections"""
+        return self.pan.position + self.pan_correction, self.tilt.position + self.tilt_correction
+
+    # ------------------------------ Packet handling ------------------------------
+    def exchange(self, packet):
+        """Handles every frame in packet, returning the concatenated replies"""
+        with self.lock:
+            self.rx_buffer += packet
+            return b''.join(self.receive_frames())
+
+    def receive_frames(self):
+        while True:
+            start = self.rx_buffer.find(STX)
+            if start < 0:
+                self.rx_buffer.clear()
+                return
+            end = self.rx_buffer.find(ETX, start + 1)
+            if end < 0:
+                del self.rx_buffer[:start]
+                return
+            frame = bytes(self.rx_buffer[start + 1:end])
+            del self.rx_buffer[:end + 1]
+            payload = codec.unescape(frame)
+            if len(payload) < 2 or not codec.valid_LRC(payload):
+                continue  # Corrupt frames get no reply, like a checksum error on the QPT
+            self.frames += 1
+            self.update()
+            self.last_rx = self.clock()
+            reply = self.handle(payload[0], payload[1:-1])
+            if reply is not None:
+                yield codec.frame(reply)
+
+    def handle(self, cmd, data):
+        """Executes one command, returning the reply data (command byte first) or None"""
+        if cmd == 0x31 and len(data) >= 5:
+            self.get_status_jog(data)
+            return self.status(cmd)
+        elif cmd == 0x33 and len(data) >= 4:
+            pan, tilt = centidegrees(data[0:2]), centidegrees(data[2:4])
+            self.move(pan - self.pan_correction, tilt - self.tilt_correction)
+            return self.status(cmd)
+        elif cmd == 0x34 and len(data) >= 4:
+            self.move(self.pan.position + centidegrees(data[0:2]),
+                      self.tilt.position + centidegrees(data[2:4]))
+            return self.status(cmd)
+        elif cmd == 0x35:
+            self.move(0.0, 0.0)
+            return self.status(cmd)
+        elif cmd in (0x70, 0x80, 0x82, 0x84):
+            if cmd == 0x80 and len(data) >= 4:
+                self.pan_correction = centidegrees(data[0:2])
+                self.tilt_correction = centidegrees(data[2:4])
+            elif cmd == 0x82:
+                self.pan_correction = -self.pan.position
+                self.tilt_correction = -self.tilt.position
+            elif cmd == 0x84:
+                self.pan_correction = 0.0
+                self.tilt_correction = 0.0
+            return bytes([cmd]) + to_centidegrees(self.pan_correction) + to_centidegrees(self.tilt_correction)
+        elif cmd in (0x71, 0x81) and len(data) >= 1 and data[0] < 4:
+            axis, attr = [(self.pan, 'high_limit'), (self.pan, 'low_limit'),
+                          (self.tilt, 'high_limit'), (self.tilt, 'low_limit')][data[0]]
+            if cmd == 0x81:
+                setattr(axis, attr, axis.position)
+            correction = self.pan_correction if axis is self.pan else self.tilt_correction
+            return bytes([cmd, data[0]]) + to_centidegrees(getattr(axis, attr) + correction)
+        elif cmd in (0x90, 0x91):
+            if cmd == 0x91:
+                self.pan.center_RU = int(round(self.pan.position * 100))
+                self.tilt.center_RU = int(round(self.tilt.position * 100))
+            return bytes([cmd]) + int16(self.pan.center_RU) + int16(self.tilt.center_RU)
+        elif cmd in (0x92, 0x93):
+            if cmd == 0x93 and len(data) >= 2:
+                self.pan.min_speed, self.tilt.min_speed = data[0], data[1]
+            return bytes([cmd, self.pan.min_speed, self.tilt.min_speed])
+        elif cmd in (0x98, 0x99):
+            if cmd == 0x99 and len(data) >= 2:
+                self.pan.max_speed, self.tilt.max_speed = data[0], data[1]
+            return bytes([cmd, self.pan.max_speed, self.tilt.max_speed])
+        elif cmd == 0x96 and len(data) >= 1:
+            if not data[0] & BIT7:
+                self.comms_timeout = data[0]
+            return bytes([cmd, self.comms_timeout])
+        return None
+
+    def get_status_jog(self, data):
+        control, pan, tilt = data[0], data[1], data[2]
+        if control & BIT0:
+            # Fault reset clears the latching hard faults
+            self.pan.faults &= ~LATCHING_FAULTS
+            self.tilt.faults &= ~LATCHING_FAULTS
+        if control & BIT1:
+            self.pan.stop()
+            self.tilt.stop()
+            return
+        self.soft_limit_override = bool(control & BIT2)
+        deadline = self.clock() + self.jog_timeout
+        if pan >> 1:
+            self.dest_coords = False
+            self.pan.jog(pan >> 1, pan & BIT0, deadline)
+        if tilt >> 1:
+            self.dest_coords = False
+            self.tilt.jog(tilt >> 1, tilt & BIT0, deadline)
+
+    def move(self, pan, tilt):
+        self.dest_coords = False
+        self.pan.move(pan)
+        self.tilt.move(tilt)
+        if not self.executing():
+            self.dest_coords = True
+
+    def status(self, cmd):
+        pan, tilt = self.reported()
+        general = BIT7  # High resolution
+        if self.executing():
+            general |= BIT6
+        if self.dest_coords:
+            general |= BIT5
+        if self.soft_limit_override:
+            general |= BIT4
+        if self.pan.is_moving():
+            general |= BIT3 if self.pan.direction > 0 else BIT2
+        if self.tilt.is_moving():
+            general |= BIT1 if self.tilt.direction > 0 else BIT0
+        return bytes([cmd]) + to_centidegrees(pan) + to_centidegrees(tilt) + \
+            bytes([self.pan.status_byte(), self.tilt.status_byte(), general])
+
+    # ------------------------------ Pseudo-terminal ------------------------------
+    @property
+    def resource(self):
+        """pyvisa resource name of the pty, for Comms/Positioner"""
+        return 'ASRL{}::INSTR'.format(self.port)
+
+    def start(self):
+        """Opens a pty and serves it from a daemon thread. Returns the device path"""
+        import tty
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)  # ETX is Ctrl-C, so the line discipline must not touch it
+        self.port = os.ttyname(self.slave)
+        self.running = True
+        self.thread = Thread(target=self.serve, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def serve(self):
+        while self.running:
+            ready, _, _ = select.select([self.master], [], [], .05)
+            if not ready:
+                with self.lock:
+                    self.update()
+                continue
+            try:
+                data = os.read(self.master, 4096)
+            except OSError:
+                break
+            reply = self.exchange(data)
+            if reply:
+                if self.reply_delay:
+                    time.sleep(self.reply_delay)
+                os.write(self.master, reply)
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+"""End VirtualQPT Class"""
+
+
+def centidegrees(data):
+    return int.from_bytes(data, byteorder='little', signed=True) / 100
+
+
+def int16(value):
+    return max(-32768, min(32767, value)).to_bytes(2, byteorder='little', signed=True)
+
+
+def to_centidegrees(angle):
+    return int16(int(round(angle * 100)))
+
+
+if __name__ == '__main__':
+    qpt = VirtualQPT()
+    port = qpt.start()
+    print('Virtual QPT-130 on {} (pyvisa resource {})'.format(port, qpt.resource))
+    try:
+        while True:
+            time.sleep(1)
+            pan, tilt = qpt.reported()
+            print('PAN: {:7.2f}  TILT: {:6.2f}  frames: {}'.format(pan, tilt, qpt.frames))
+    except KeyboardInterrupt:
+        qpt.stop()
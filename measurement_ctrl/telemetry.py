@@ -0,0 +1,103 @@
+################################################################################
+# telemetry
+# Description:
+#   Fixed size ring buffer of positioner telemetry. The QPT thread appends a
+#   sample (monotonic time, pan, tilt, status bits) for every status frame it
+#   parses, and any other thread can read the motion history without locking,
+#   e.g. to interpolate the angle at the time of a VNA sweep, to look at the
+#   polling jitter, or to plot the path of a move.
+#
+#   There is a single writer. It fills the slot at count and only then
+#   advances count, so a reader copies the slots below count and checks count
+#   again to see whether the writer wrapped around into what it copied,
+#   retrying if so. The slot at count may be half written at any time, so at
+#   most size - 1 samples are readable.
+#
+# Status: Complete
+# Dependencies: numpy
+#
+# Built with Python Version: 3.8.5
+################################################################################
+import numpy as np
+
+
+class TelemetryBuffer:
+    """Ring buffer of the last size - 1 positioner samples. status holds the pan,
+    tilt and general status bytes of the frame as (pan << 16 | tilt << 8 | general)
+    """
+    _RETRIES = 5 # snapshot attempts before giving up on a writer that keeps lapping
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.time = np.zeros(size)
+        self.pan = np.zeros(size)
+        self.tilt = np.zeros(size)
+        self.status = np.zeros(size, dtype=np.uint32)
+        self.count = 0 # samples ever appended, only advanced by the writer
+
+    def append(self, t, pan, tilt, status):
+        """Adds a sample; must only be called from the one writing thread"""
+        i = self.count % self.size
+        self.time[i] = t
+        self.pan[i] = pan
+        self.tilt[i] = tilt
+        self.status[i] = status
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size - 1)
+
+    def latest(self):
+        """Returns the newest sample as (time, pan, tilt, status), or None"""
+        for _ in range(self._RETRIES):
+            count = self.count
+            if count == 0:
+                return None
+            i = (count - 1) % self.size
+            sample = (float(self.time[i]), float(self.pan[i]), float(self.tilt[i]), int(self.status[i]))
+            # The slot of the sample is reused once the writer gets size - 1 ahead
+            if self.count - count < self.size - 1:
+                return sample
+        return None
+
+    def snapshot(self, n=None):
+        """Returns copies of the newest n samples (all if n is None), oldest first,
+        as the arrays (time, pan, tilt, status)"""
+        for _ in range(self._RETRIES):
+            count = self.count
+            length = min(count, self.size - 1) if n is None else min(n, count, self.size - 1)
+            index = np.arange(count - length, count) % self.size
+            arrays = (self.time[index], self.pan[index], self.tilt[index], self.status[index])
+            # The writer has been filling slots from count on, up to and including
+            # the one at self.count, and must not have reached the oldest copied one
+            if self.count - count < self.size - length:
+                return arrays
+        raise Exception('Telemetry is being written faster than it can be read')
+
+    def since(self, t):
+        """Returns the samples taken at or after monotonic time t, like snapshot()"""
+        arrays = self.snapshot()
+        start = np.searchsorted(arrays[0], t)
+        return tuple(a[start:] for a in arrays)
+
+    def interpolate(self, t, extrapolate=0.0):
+        """Returns the (pan, tilt) angles linearly interpolated at monotonic time t,
+        which may be a scalar or an array of times. Times up to extrapolate seconds
+        after the newest sample are extrapolated from the last two samples. Returns
+        None if t is not covered: before the oldest sample or further after the newest"""
+        times, pan, tilt, status = self.snapshot()
+        if len(times) == 0 or np.min(t) < times[0] or np.max(t) > times[-1] + extrapolate:
+            return None
+        pan_t, tilt_t = np.interp(t, times, pan), np.interp(t, times, tilt)
+        if len(times) > 1 and np.max(t) > times[-1]:
+            dt = times[-1] - times[-2]
+            after = np.maximum(np.asarray(t) - times[-1], 0)
+            if dt > 0:
+                pan_t = pan_t + after * (pan[-1] - pan[-2]) / dt
+                tilt_t = tilt_t + after * (tilt[-1] - tilt[-2]) / dt
+        return pan_t, tilt_t
+
+    def intervals(self):
+        """Returns the times between consecutive samples, to look at polling jitter"""
+        return np.diff(self.snapshot()[0])
+"""End TelemetryBuffer Class"""
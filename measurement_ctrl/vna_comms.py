@@ -8,6 +8,7 @@
 #
 #  Dependencies:    
 #   PyVISA   Version: 10.0.1
+#   Numpy    Version: 1.19.3
 #   NI-488.2 Version: 19.5
 #   NI-VISA  Version: 19.5
 #
@@ -18,7 +19,7 @@
 ################################################################################
 import pyvisa as visa
 import math
-from struct import unpack
+import numpy as np
 from measurement_ctrl.vna_syntaxes import *
 
 
@@ -32,6 +33,43 @@ class Data:
         self.value_phase = value_phase
 
 
+class Trace:
+    """Columnar record of one VNA trace. The per-frequency values are kept as
+    parallel numpy arrays (freq, value_mag, value_phase), while the values
+    shared by every point of the trace (measurement type and positioner
+    coordinates) are stored once. Indexing or iterating a Trace yields a
+    Data view per point for callers that still expect Data objects.
+
+    phi may also be an array with the angle of every point, for traces taken
+    while the positioner moves. sweep_start and sweep_end are the monotonic
+    times the trace was averaged over, when known."""
+    def __init__(self, measurement_type, freq, theta, phi, value_mag, value_phase):
+        self.measurement_type = measurement_type
+        self.freq = np.asarray(freq, dtype=np.float64)
+        self.theta = theta
+        self.phi = phi
+        self.value_mag = np.asarray(value_mag, dtype=np.float64)
+        self.value_phase = np.asarray(value_phase, dtype=np.float64)
+        self.sweep_start = None
+        self.sweep_end = None
+
+    def __len__(self):
+        return len(self.freq)
+
+    def __getitem__(self, i):
+        phi = float(self.phi[i]) if isinstance(self.phi, np.ndarray) else self.phi
+        return Data(self.measurement_type, float(self.freq[i]), self.theta, phi,
+                    float(self.value_mag[i]), float(self.value_phase[i]))
+
+    def __iter__(self):
+        for i in range(0, len(self.freq)):
+            yield self[i]
+
+    def to_data(self):
+        """Returns the trace as a list of Data objects, one per frequency"""
+        return list(self)
+
+
 class LinFreq:
     """Class to describe the information needed for a linear frequency sweep"""
     def __init__(self, start, end, points):
@@ -41,29 +79,69 @@ class LinFreq:
 
 
 class Session:
-    def __init__(self, resource):
-        self.rm = visa.ResourceManager()
+    def __init__(self, resource, headless=False, rm=None):
+        # rm can be given to use another resource manager, e.g. vna_simulator's
+        self.rm = rm if rm is not None else visa.ResourceManager()
         self.vna = self.rm.open_resource(resource)
         self.vna.read_termination = '\n'
         del self.vna.timeout
         self.model = check_model(self.vna.query('*IDN?'))
+        self.batching = supports_batching(self.model)  # True if commands can be joined into one write
+        self.headless = headless  # True to skip commands that only change the display
         self.vna.write(form2(self.model))
         self.freq = None
         self.using_correction = False
+        self.held = False  # True while sweeping is stopped by hold()
+        self.state = {}  # Shadow copy of the instrument settings last sent, see changed()
 
     def reset_all(self):
         """Resets the entire machine to factory presets"""
-        self.vna.write(reset(self.model))
+        self.write_batch([reset(self.model)])
         self.using_correction = False
+        self.held = False
+        self.state.clear()
         return 0
 
     def reset(self):
         """Resets ONLY measurement parameters changed in setup, nothing else"""
-        self.vna.write(edit_list(self.model))
-        self.vna.write(clear_list(self.model))
+        self.write_batch([edit_list(self.model),
+                          clear_list(self.model)])
+        self.state.clear()
+
+    def resync(self):
+        """Forgets the shadow state, so every setting is sent again the next time it is
+        needed. Use this if the instrument may have been changed from its front panel"""
+        self.state.clear()
+
+    def changed(self, setting, value):
+        """Returns True, recording the new value, if the instrument setting does not
+        already hold value. Commands for settings that did not change are not sent"""
+        if setting in self.state and self.state[setting] == value:
+            return False
+        self.state[setting] = value
+        return True
+
+    def write_batch(self, commands):
+        """Sends the commands of one logical operation. Models that accept semicolon
+        separated commands get a single write, others get one write per command.
+        None entries (commands skipped for this model or mode) are left out"""
+        commands = [c for c in commands if c]
+        if not commands:
+            return
+        try:
+            if self.batching:
+                self.vna.write(';'.join(commands))
+            else:
+                for c in commands:
+                    self.vna.write(c)
+        except Exception:
+            # The instrument state is unknown after a failed write
+            self.state.clear()
+            raise
 
     def setup(self, freq, avg, bw):
         self.freq = freq
+        commands = []
 
         # Setup procedure for a list frequency sweep:
         # 1. Adding each frequency as a separate segment on the VNA
@@ -72,11 +150,13 @@ class Session:
             # if sweep type is frequency list, only take a max of 30 frequencies
             if len(self.freq) > 30:
                 raise Exception('The number of frequencies in the frequency list exceeded 30.')
-            for i in range(0, len(self.freq)):
-                freq_temp = self.freq[i]
-                self.vna.write(edit_list(self.model))
-                self.vna.write(add_list_freq(self.model, int(freq_temp * 1000)))
-            self.vna.write(list_freq_mode(self.model))
+            if self.changed('list', tuple(self.freq)):
+                for i in range(0, len(self.freq)):
+                    freq_temp = self.freq[i]
+                    commands.append(edit_list(self.model))
+                    commands.append(add_list_freq(self.model, int(freq_temp * 1000)))
+            if self.changed('sweep_type', 'list'):
+                commands.append(list_freq_mode(self.model))
 
         # Setup procedure for a linear frequency sweep
         # 1. Indicate start frequency (in kHz b/c pyvisa does not deal well with decimals, for reasons unknown)
@@ -84,10 +164,14 @@ class Session:
         # 3. Indicate number of points
         # 4. Changing frequency sweep mode to a linear sweep
         else:
-            self.vna.write(lin_freq_start(self.model, int(self.freq.start * 1000)))
-            self.vna.write(lin_freq_end(self.model, int(self.freq.end * 1000)))
-            self.vna.write(lin_freq_points(self.model, self.freq.points))
-            self.vna.write(lin_freq_mode(self.model))
+            if self.changed('start', int(self.freq.start * 1000)):
+                commands.append(lin_freq_start(self.model, int(self.freq.start * 1000)))
+            if self.changed('stop', int(self.freq.end * 1000)):
+                commands.append(lin_freq_end(self.model, int(self.freq.end * 1000)))
+            if self.changed('points', self.freq.points):
+                commands.append(lin_freq_points(self.model, self.freq.points))
+            if self.changed('sweep_type', 'linear'):
+                commands.append(lin_freq_mode(self.model))
 
         # Remaining steps are shared among linear and list sweeps:
         # 1. Set the averaging factor
@@ -95,23 +179,23 @@ class Session:
         # 3. Reset the averaging
         # 4. Set the IF bandwidth (in Hz)
         # 5. Turn on error correction if needed
-        self.vna.write(avg_factor(self.model, avg))
-        self.vna.write(avg_on(self.model))
-        self.vna.write(avg_reset(self.model))
-        self.vna.write(if_bw(self.model, bw))
+        if self.changed('avg_factor', avg):
+            commands.append(avg_factor(self.model, avg))
+        if self.changed('averaging', True):
+            commands.append(avg_on(self.model))
+        commands.append(avg_reset(self.model))
+        if self.changed('if_bw', bw):
+            commands.append(if_bw(self.model, bw))
         # if self.using_correction:
-        #     self.vna.write(correction_on(self.model))
+        #     commands.append(correction_on(self.model))
+        self.write_batch(commands)
         return 0
 
 
     def get_data(self, theta, phi, data_type):
-        """Returns one data point for every frequency specified in setup.
-        Each data point contains the data type (S11 vs S21), positioner coordinates,
+        """Returns a Trace holding one data point for every frequency specified in setup.
+        The trace contains the data type (S11 vs S21), positioner coordinates,
         and magnitude (dB) and phase (degrees) of the data"""
-        temp_data_set = []
-        output_real = []
-        output_im = []
-
         # Action to perform on the VNA
         # 1. Display both data (current, live trace) and memory (saved snapshot) on the VNA
         # 2. Display in polar format
@@ -119,80 +203,110 @@ class Session:
         # 4. Auto scale the data
         # 5. Save data to memory
         # 6. Send data back
-        self.vna.write(display_data_and_mem(self.model))
-        self.vna.write(polar(self.model))
-        self.vna.write(polar_log_marker(self.model))
-        self.vna.write(auto_scale(self.model))
-        self.vna.write(data_to_mem(self.model))
-        self.vna.write(output_formatted_data(self.model))
+        # Steps 1 and 4 only change the display, so they are skipped when headless.
+        # Steps 1 to 3 are only sent when the setting changed, and the display is
+        # auto scaled once per selected parameter
+        commands = []
+        if not self.headless and self.changed('display', 'data_and_mem'):
+            commands.append(display_data_and_mem(self.model))
+        if self.changed('format', 'polar'):
+            commands.append(polar(self.model))
+        if self.changed('marker', 'polar_log'):
+            commands.append(polar_log_marker(self.model))
+        if not self.headless and self.changed('scaled', self.state.get('parameter')):
+            commands.append(auto_scale(self.model))
+        commands.append(data_to_mem(self.model))
+        commands.append(output_formatted_data(self.model))
+        self.write_batch(commands)
 
         # Data is sent back in the following format:
         # data header | real component | imaginary component | real component | imaginary component......
         #  (4 bytes)  |   (4 bytes)    |     (4 bytes)       |   (4 bytes)    |     (4 bytes)....
         #             |   Value for 1st frequency            |         Value for 2nd frequency .......
         #
-        # Data is sorted into two lists: one for real component, and one for imaginary component
-        # Once all data is sorted, it is converted from rectangular to polar form then returned
+        # The whole block is decoded into real and imaginary arrays at once, then
+        # converted from rectangular to polar form for the entire trace
         if isinstance(self.freq, list):
-            output = self.vna.read_bytes(4 + 8 * len(self.freq))
-            x = 0
-            while x < 2 * len(self.freq):
-                output_real.append(unpack('>f', output[4 * (x + 1):4 * (x + 2)])[0])
-                x = x + 1
-                output_im.append(unpack('>f', output[4 * (x + 1):4 * (x + 2)])[0])
-                x = x + 1
-        else:
-            output = self.vna.read_bytes(4 + 8 * self.freq.points)
-            x = 0
-            while x < 2 * self.freq.points:
-                output_real.append(unpack('>f', output[4 * (x + 1):4 * (x + 2)])[0])
-                x = x + 1
-                output_im.append(unpack('>f', output[4 * (x + 1):4 * (x + 2)])[0])
-                x = x + 1
-
-        if isinstance(self.freq, list):
-            length = len(self.freq)
-            for i in range(0, length):
-                rect_temp = [output_real[i], output_im[i]]
-                mag_temp = 20 * math.log(math.sqrt(rect_temp[0] * rect_temp[0] + rect_temp[1] * rect_temp[1]) + 1e-60,
-                                         10)
-                phase_temp = phase(rect_temp)
-                if data_type == 'S21':
-                    temp_data_set.append(Data('S21', self.freq[i], theta, phi, mag_temp, phase_temp))
-                else:
-                    temp_data_set.append(Data('S11', self.freq[i], theta, phi, mag_temp, phase_temp))
+            points = len(self.freq)
+            freqs = np.array(self.freq, dtype=np.float64)
         else:
+            points = self.freq.points
             span = self.freq.end - self.freq.start
-            for i in range(0, self.freq.points):
-                freq = self.freq.start + i * span / (self.freq.points - 1)
-                rect_temp = [output_real[i], output_im[i]]
-                mag_temp = 20 * math.log(math.sqrt(rect_temp[0] * rect_temp[0] + rect_temp[1] * rect_temp[1]) + 1e-60,
-                                         10)
-                phase_temp = phase(rect_temp)
-                if data_type == 'S21':
-                    temp_data_set.append(Data('S21', freq, theta, phi, mag_temp, phase_temp))
-                else:
-                    temp_data_set.append(Data('S11', freq, theta, phi, mag_temp, phase_temp))
-        return temp_data_set
+            freqs = self.freq.start + np.arange(points) * span / (points - 1)
+
+        output = self.vna.read_bytes(4 + 8 * points)
+        output_real, output_im = decode_form2(output, points)
+
+        data_type = 'S21' if data_type == 'S21' else 'S11'
+        return Trace(data_type, freqs, theta, phi,
+                     magnitude_db(output_real, output_im),
+                     phase_array(output_real, output_im))
 
     def calibrate_open(self):
-        self.vna.write(cal_s11_1_port(self.model))
-        self.vna.write(cal_s11_1_port_open(self.model))
+        self.write_batch([cal_s11_1_port(self.model),
+                          cal_s11_1_port_open(self.model)])
         self.using_correction = True
+        self.resync()  # The calibration sequence selects its own parameter and display
 
     def calibrate_short(self):
-        self.vna.write(cal_s11_1_port_short(self.model))
+        self.write_batch([cal_s11_1_port_short(self.model)])
 
     def calibrate_load(self):
-        self.vna.write(cal_s11_1_port_load(self.model))
-        self.vna.write(save_1_port_cal(self.model))
-        self.vna.write(correction_on(self.model))
+        self.write_batch([cal_s11_1_port_load(self.model),
+                          save_1_port_cal(self.model),
+                          correction_on(self.model)])
+        self.resync()
+
+    def hold(self):
+        """Stops sweeping so the averaged trace stays in place while it is transferred.
+        Models without a hold command keep sweeping"""
+        command = hold(self.model)
+        if command:
+            self.write_batch([command])
+            self.held = True
+
+    def resume_sweep(self):
+        """Resumes continuous sweeping after hold()"""
+        command = continuous_sweep(self.model)
+        if command:
+            self.write_batch([command])
+            self.held = False
+
+    def wait_avg_complete(self, avg, timeout):
+        """Waits until avg sweeps have completed after an averaging reset, for at most
+        timeout seconds. The VNA holds afterwards. Returns False if the model can not
+        report completion or the timeout passed, so a timed wait can be used instead"""
+        command = num_groups_complete(self.model, avg)
+        if command is None:
+            return False
+        self.vna.timeout = int(timeout * 1000)
+        try:
+            self.vna.query(command)
+        except visa.errors.VisaIOError:
+            # Abort the pending reply so it is not read as the answer to a later query,
+            # and sweep again, since it is unknown whether the aborted sweeps held
+            self.vna.clear()
+            self.held = False
+            self.write_batch([continuous_sweep(self.model)])
+            return False
+        finally:
+            del self.vna.timeout
+        self.held = True
+        return True
 
     def rst_avg(self, data_type):  # the S11 and S21 commands automatically trigger an averaging reset in the VNA
-        if data_type == 'S11':
-            self.vna.write(s11(self.model))
-        elif data_type == 'S21':
-            self.vna.write(s21(self.model))
+        commands = []
+        if self.held:
+            # A held trace can not be averaged, so resume sweeping first
+            commands.append(continuous_sweep(self.model))
+            self.held = False
+        if data_type == 'S11' or data_type == 'S21':
+            if self.changed('parameter', data_type):
+                commands.append(s11(self.model) if data_type == 'S11' else s21(self.model))
+            else:
+                # Parameter already selected, so only restart the averaging
+                commands.append(avg_reset(self.model))
+        self.write_batch(commands)
 
 
 def phase(rect_coord):
@@ -215,3 +329,29 @@ def phase(rect_coord):
         elif rect_coord[1] < 0:
             p = p - 180
     return p
+
+
+def decode_form2(block, points):
+    """Decodes a FORM2 block (4 byte header followed by big-endian 32-bit
+    float real/imaginary pairs) into two float64 arrays in a single pass"""
+    values = np.frombuffer(block, dtype='>f4', count=2 * points, offset=4).astype(np.float64)
+    return values[0::2], values[1::2]
+
+
+def magnitude_db(real, imag):
+    """Vectorized magnitude in dB, 20 * log10(sqrt(re^2 + im^2) + 1e-60),
+    for every point of a trace"""
+    return 20 * (np.log(np.sqrt(real * real + imag * imag) + 1e-60) / math.log(10))
+
+
+def phase_array(real, imag):
+    """Vectorized version of phase() for whole traces, following the same
+    quadrant rules, including the values used on the real and imaginary axes"""
+    real = np.asarray(real, dtype=np.float64)
+    imag = np.asarray(imag, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.degrees(np.arctan(imag / real))
+    p = np.where(real < 0, np.where(imag > 0, p + 180, np.where(imag < 0, p - 180, p)), p)
+    p = np.where(imag == 0, np.where(real > 0, 0.0, 180.0), p)
+    p = np.where(real == 0, np.where(imag > 0, 90.0, -90.0), p)
+    return p
@@ -0,0 +1,352 @@
+################################################################################
+# vna_simulator
+# Description:
+#   Simulated HP 8753D that can stand in for the pyvisa GPIB resource used
+#   by vna_comms.Session, so the acquisition path can be run and profiled
+#   without an instrument. It answers *IDN? as an 8753D, accepts the
+#   commands generated by vna_syntaxes (one per write or semicolon separated),
+#   and returns FORM2 blocks from read_bytes. Sweeps, averaging and GPIB
+#   transfers take time based on the number of points, the IF bandwidth and
+#   the averaging factor, and traces are a synthetic antenna pattern that
+#   depends on the positioner angle at the time of the sweep.
+#
+#   Usage:
+#       rm = SimulatedResourceManager(angle=lambda: (tilt, pan))
+#       session = vna_comms.Session('GPIB0::16::INSTR', rm=rm)
+#   or pass vna_rm=rm to MeasurementCtrl.
+#
+#   Running this module profiles a full MeasurementCtrl.run step sweep
+#   against the simulator:
+#       python -m measurement_ctrl.vna_simulator [--resolution 10] [--points 201]
+#
+# Dependencies:
+#   PyVISA Version: 1.10.1
+#   Numpy  Version: 1.19.3
+#
+# Built with Python Version: 3.8.5
+################################################################################
+import math
+from time import sleep, perf_counter
+import numpy as np
+import pyvisa as visa
+
+
+IDN = 'HEWLETT PACKARD,8753D,0,6.14'
+
+
+class SimulatedVNA:
+    def __init__(self, angle=None, point_time=None, sweep_overhead=.01,
+                 transfer_rate=100e3, command_latency=.001, noise=.002, time_scale=1.0):
+        """
+        :param angle: Function returning the current (theta, phi) of the positioner
+                      in degrees, used for the antenna pattern. Defaults to (0, 0)
+        :param point_time: Seconds per point of a sweep. Defaults to a value based on
+                           the IF bandwidth, 1.5 / bandwidth + 0.2 ms
+        :param sweep_overhead: Seconds added to every sweep for retrace
+        :param transfer_rate: Bytes per second of GPIB data transfers
+        :param command_latency: Seconds taken by every write
+        :param noise: Standard deviation of the trace noise before averaging
+        :param time_scale: Factor applied to every delay, 0 for no delays
+        """
+        self.angle = angle if angle is not None else (lambda: (0.0, 0.0))
+        self.point_time = point_time
+        self.sweep_overhead = sweep_overhead
+        self.transfer_rate = transfer_rate
+        self.command_latency = command_latency
+        self.noise = noise
+        self.time_scale = time_scale
+        self.read_termination = '\n'
+        self.timeout = 2000  # ms, deleted by Session for no timeout, like pyvisa
+        self.rng = np.random.default_rng(0)
+        self.commands = 0  # Number of commands received, for profiling
+        self.writes = 0  # Number of writes received, for profiling
+        self.replies = []
+        self.block = None  # FORM2 block waiting to be read
+        self.opc = False  # True if the command being executed follows OPC?
+        self.preset()
+
+    # ------------------------------ Instrument state -----------------------------
+    def preset(self):
+        self.start = 30.0  # MHz
+        self.stop = 6000.0  # MHz
+        self.points = 201
+        self.segments = []  # List sweep center frequencies in MHz
+        self.editing_list = False
+        self.list_mode = False
+        self.avg_factor = 16
+        self.averaging = False
+        self.bw = 3700
+        self.parameter = 'S11'
+        self.corrected = False
+        self.held = False
+        self.sweep_start = perf_counter()  # Start of the sweeps averaged into the trace
+        self.held_sweeps = 0  # Sweeps averaged into the trace when it was held
+        self.held_angle = (0.0, 0.0)
+
+    def frequencies(self):
+        if self.list_mode:
+            return np.array(self.segments, dtype=np.float64)
+        return np.linspace(self.start, self.stop, self.points)
+
+    def sweep_time(self):
+        point_time = self.point_time
+        if point_time is None:
+            point_time = 1.5 / self.bw + .0002
+        return self.sweep_overhead + len(self.frequencies()) * point_time
+
+    def sweeps_done(self):
+        if self.held:
+            return self.held_sweeps
+        sweep_time = self.sweep_time() * self.time_scale
+        if sweep_time <= 0:
+            return self.avg_factor
+        return int((perf_counter() - self.sweep_start) / sweep_time)
+
+    def restart_sweeps(self):
+        self.held = False
+        self.sweep_start = perf_counter()
+
+    def hold(self):
+        self.held_sweeps = self.sweeps_done()
+        self.held_angle = self.angle()
+        self.held = True
+
+    def delay(self, seconds):
+        if seconds * self.time_scale > 0:
+            sleep(seconds * self.time_scale)
+
+    # ------------------------------ Synthetic trace ------------------------------
+    def trace(self):
+        """Returns the complex trace of the active parameter"""
+        freq = self.frequencies()
+        theta, phi = self.held_angle if self.held else self.angle()
+        if self.parameter == 'S21':
+            # Main lobe at phi = 0, narrowing with frequency, and a floor for the nulls
+            f = (freq - freq.min()) / (np.ptp(freq) + 1e-9)
+            lobe = np.abs(math.cos(math.radians(phi) / 2)) ** (1 + 3 * f)
+            tilt = 1 - .1 * (1 - math.cos(math.radians(theta)))
+            magnitude = .1 * (.01 + lobe) * tilt
+            phase = -2 * math.pi * freq * 1e6 * .1 * math.cos(math.radians(phi)) / 3e8
+        else:
+            # Antenna match, a resonance independent of the positioner angle
+            magnitude = .2 + .1 * np.cos(2 * math.pi * freq / 500)
+            phase = -2 * math.pi * freq * 1e6 * .05 / 3e8
+        sweeps = max(1, min(self.sweeps_done(), self.avg_factor if self.averaging else 1))
+        noise = self.noise / math.sqrt(sweeps)
+        values = magnitude * np.exp(1j * phase)
+        values = values + noise * (self.rng.standard_normal(len(freq))
+                                   + 1j * self.rng.standard_normal(len(freq)))
+        return values
+
+    def form2_block(self):
+        """FORM2 block: '#A', 2 byte length, then big-endian 32-bit real/imaginary pairs"""
+        values = self.trace()
+        data = np.empty(2 * len(values), dtype='>f4')
+        data[0::2] = values.real
+        data[1::2] = values.imag
+        payload = data.tobytes()
+        return b'#A' + len(payload).to_bytes(2, 'big') + payload
+
+    # ------------------------------ pyvisa resource ------------------------------
+    def write(self, message):
+        self.writes += 1
+        self.delay(self.command_latency)
+        for command in message.split(';'):
+            command = command.strip()
+            if command:
+                self.execute(command)
+        return len(message)
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def read(self):
+        if not self.replies:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        return self.replies.pop(0)
+
+    def read_bytes(self, count):
+        if self.block is None:
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        block, self.block = self.block, None
+        self.delay(len(block) / self.transfer_rate)
+        if len(block) < count:
+            raise Exception('Simulated 8753D sent {} bytes, {} were requested'.format(len(block), count))
+        return block[:count]
+
+    def clear(self):
+        self.replies = []
+        self.block = None
+
+    def close(self):
+        pass
+
+    # ------------------------------ Command parser -------------------------------
+    def execute(self, command):
+        self.commands += 1
+        parts = command.split()
+        mnemonic = parts[0].upper()
+        args = parts[1:]
+
+        if mnemonic == '*IDN?':
+            self.replies.append(IDN)
+        elif mnemonic == 'OPC?':
+            self.opc = True
+        elif mnemonic == 'PRES':
+            self.preset()
+        elif mnemonic in ('FORM2', 'POLA', 'POLMLOG', 'AUTO', 'DISPDATM', 'DATI',
+                          'CALIS111', 'CLASS11A', 'CLASS11B', 'CLASS11C'):
+            pass
+        elif mnemonic == 'EDITLIST':
+            self.editing_list = True
+        elif mnemonic == 'CLEL':
+            self.segments = []
+        elif mnemonic == 'SADD':
+            self.segments.append(None)
+        elif mnemonic == 'CENT':
+            self.segments[-1] = frequency(args)
+        elif mnemonic == 'SDON':
+            self.editing_list = False
+        elif mnemonic == 'LISFREQ':
+            self.list_mode = True
+            self.restart_sweeps()
+        elif mnemonic == 'LINFREQ':
+            self.list_mode = False
+            self.restart_sweeps()
+        elif mnemonic == 'STAR':
+            self.start = frequency(args)
+        elif mnemonic == 'STOP':
+            self.stop = frequency(args)
+        elif mnemonic == 'POIN':
+            self.points = int(args[0])
+        elif mnemonic == 'AVERFACT':
+            self.avg_factor = int(args[0])
+        elif mnemonic == 'AVERO1':
+            self.averaging = True
+        elif mnemonic == 'AVERREST':
+            if not self.held:
+                self.restart_sweeps()
+        elif mnemonic == 'IFBW':
+            self.bw = int(args[0])
+        elif mnemonic in ('S11', 'S21'):
+            self.parameter = mnemonic
+            if not self.held:
+                self.restart_sweeps()
+        elif mnemonic == 'SAV1':
+            self.delay(.5)
+        elif mnemonic == 'CORRON':
+            self.corrected = True
+        elif mnemonic == 'HOLD':
+            if not self.held:
+                self.hold()
+        elif mnemonic == 'CONT':
+            self.restart_sweeps()
+        elif mnemonic == 'NUMG':
+            self.num_groups(int(args[0]))
+        elif mnemonic == 'OUTPFORM':
+            self.block = self.form2_block()
+        else:
+            raise Exception('Simulated 8753D does not recognize the command: {}'.format(command))
+
+        if mnemonic != 'OPC?' and self.opc:
+            # OPC? replies once the command following it has completed
+            self.opc = False
+            self.replies.append('1')
+
+    def num_groups(self, groups):
+        """Takes groups sweeps then holds, blocking like the bus does during OPC?"""
+        duration = groups * self.sweep_time()
+        timeout = getattr(self, 'timeout', None)
+        if timeout is not None and duration * self.time_scale > timeout / 1000:
+            self.delay(timeout / 1000 / max(self.time_scale, 1e-9))
+            raise visa.errors.VisaIOError(visa.constants.StatusCode.error_timeout)
+        self.restart_sweeps()
+        self.delay(duration)
+        self.hold()
+        self.held_sweeps = groups
+"""End SimulatedVNA Class"""
+
+
+class SimulatedResourceManager:
+    """Stands in for pyvisa.ResourceManager, every resource is a SimulatedVNA"""
+
+    def __init__(self, **options):
+        self.options = options  # Keyword arguments of SimulatedVNA
+        self.resources = {}
+
+    def list_resources(self):
+        return tuple(self.resources.keys()) or ('GPIB0::16::INSTR',)
+
+    def open_resource(self, resource):
+        self.resources[resource] = SimulatedVNA(**self.options)
+        return self.resources[resource]
+"""End SimulatedResourceManager Class"""
+
+
+def frequency(args):
+    """Converts a frequency argument, e.g. ['100000', 'KHZ'], to MHz"""
+    units = {'HZ': 1e-6, 'KHZ': 1e-3, 'MHZ': 1.0, 'GHZ': 1e3}
+    value = float(args[0])
+    unit = args[1].upper() if len(args) > 1 else 'HZ'
+    return value * units[unit]
+
+
+if __name__ == '__main__':
+    import argparse
+    import cProfile
+    import os
+    import pstats
+    import tempfile
+    from measurement_ctrl.data_storage import create_file
+    from measurement_ctrl.measurement_ctrl import MeasurementCtrl
+
+    parser = argparse.ArgumentParser(description='Profile a MeasurementCtrl step sweep on a simulated 8753D')
+    parser.add_argument('--resolution', type=float, default=10, help='degrees per step')
+    parser.add_argument('--points', type=int, default=201, help='linear sweep points')
+    parser.add_argument('--averaging', type=int, default=8, help='averaging factor')
+    parser.add_argument('--time-scale', type=float, default=1.0, help='factor applied to instrument delays')
+    parser.add_argument('--top', type=int, default=20, help='number of profile entries to print')
+    options = parser.parse_args()
+
+    position = {'tilt': 0.0, 'pan': 0.0}
+    rm = SimulatedResourceManager(angle=lambda: (position['tilt'], position['pan']),
+                                  time_scale=options.time_scale)
+    args = {
+        'impedance': False,
+        'list': None,
+        'linear': {'start': 1000, 'stop': 3000, 'points': options.points},
+        'calibration': False,
+        'averaging': options.averaging,
+        'positioner_mv': 'step',
+        'offset': {'pan': 0},
+        'sweep_axis': 'pan',
+        'fixed_angle': 0,
+        'resolution': options.resolution,
+        'gpib_addr': 16,
+    }
+    data_file = os.path.join(tempfile.mkdtemp(), 'data0.csv')
+    mc = MeasurementCtrl(args, data_file, vna_rm=rm)
+    create_file(data_file, args)
+
+    def move_to(request):
+        # The positioner arrives instantly, reporting a position just past the
+        # target like the real one, so only the vna and storage are profiled
+        position['pan'] = request[0] + .01
+        mc.update_pan(float(request[0]) + .01)
+        mc.update_tilt(float(request[1]))
+        mc.update_settled(True, float(request[0]), float(request[1]))
+    mc.signals.requestMoveTo.connect(move_to)
+
+    profile = cProfile.Profile()
+    start = perf_counter()
+    profile.enable()
+    mc.run()
+    profile.disable()
+    elapsed = perf_counter() - start
+    vna = rm.resources['GPIB0::16::INSTR']
+    print('{} steps in {:.2f} s, {} writes, {} commands, data in {}'.format(
+        int(360 / options.resolution) + 1, elapsed, vna.writes, vna.commands, data_file))
+    if mc.error_message is not None:
+        print('error:', mc.error_message)
+    pstats.Stats(profile).sort_stats('cumulative').print_stats(options.top)
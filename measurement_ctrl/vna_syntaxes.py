@@ -29,6 +29,15 @@ def check_model(string):
         raise Exception('Model is either not supported, or model is not found in query message: {}'.format(string))
 
 
+def supports_batching(model):
+    """Indicate whether the VNA accepts several commands separated by
+    semicolons in a single write"""
+    capable = {
+        Model.HP_8753D: True,
+    }
+    return capable.get(model, False)
+
+
 def reset(model):
     """This action should perform a full reset on the VNA"""
     commands = {
@@ -172,6 +181,24 @@ def avg_reset(model):
     return commands.get(model)
 
 
+def num_groups_complete(model, arg):
+    """This action should take arg sweeps then hold, and reply once they are complete.
+    Models that can not report completion return None"""
+    argument_valid = {
+        Model.HP_8753D: arg in range(1, 1000),
+    }
+
+    commands = {
+        Model.HP_8753D: 'OPC?;NUMG {}'.format(arg),
+    }
+    if model not in commands:
+        return None
+    if argument_valid.get(model):
+        return commands.get(model)
+    else:
+        raise Exception('The number of groups is invalid: {}'.format(arg))
+
+
 def if_bw(model, arg):
     """This action should set the IF bandwidth"""
     argument_valid = {
@@ -203,6 +230,22 @@ def s11(model):
     return commands.get(model)
 
 
+def hold(model):
+    """This action should stop sweeping, freezing the current trace"""
+    commands = {
+        Model.HP_8753D: 'HOLD',
+    }
+    return commands.get(model)
+
+
+def continuous_sweep(model):
+    """This action should resume continuous sweeping"""
+    commands = {
+        Model.HP_8753D: 'CONT',
+    }
+    return commands.get(model)
+
+
 def polar(model):
     """This action should select the polar display format"""
     commands = {
@@ -0,0 +1,102 @@
+################################################################################
+#  vna_timing
+#
+#  Description: Measures how long the connected VNA takes to reset averaging,
+#               complete averaging and transfer a trace for the configured
+#               sweep, and caches the results in a JSON file next to the data
+#               files, keyed by VNA model, sweep type, number of points,
+#               averaging factor and IF bandwidth. Measurement Control uses
+#               these values for its delays and positioner speeds in place of
+#               the worst case values of its built in table.
+#  Dependencies: n/a
+#
+#  Built with Python Version: 3.8.5
+################################################################################
+import os
+import json
+from time import perf_counter
+
+
+CACHE_FILE = 'vna_timing.json'
+MARGIN = 1.05       # measured times are scaled by this factor
+MARGIN_FIXED = .05  # and then padded by this many seconds
+
+
+def cache_path(data_file):
+    """Returns the location of the timing cache for the directory of data_file"""
+    return os.path.join(os.path.dirname(os.path.abspath(data_file)), CACHE_FILE)
+
+
+def timing_key(model, freq, avg, bw):
+    """Returns the cache key of a sweep configuration.
+    freq is either a list of frequencies or a LinFreq object"""
+    if isinstance(freq, list):
+        sweep, points = 'list', len(freq)
+    else:
+        sweep, points = 'linear', freq.points
+    return '{}|{}|{}|{}|{}'.format(model.name, sweep, points, avg, bw)
+
+
+def load_cache(path):
+    """Returns the cached timings, or an empty dictionary if there are none"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, cache):
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def lookup(path, key):
+    """Returns the cached [averaging delay, S11 delay, S21 delay] of key, or None"""
+    delays = load_cache(path).get(key)
+    if delays is None or len(delays) != 3:
+        return None
+    return [float(d) for d in delays]
+
+
+def store(path, key, delays):
+    cache = load_cache(path)
+    cache[key] = delays
+    save_cache(path, cache)
+
+
+def pad(seconds):
+    return round(seconds * MARGIN + MARGIN_FIXED, 3)
+
+
+def average(session, avg, timeout):
+    """Waits for avg sweeps after an averaging reset, raising an Exception if the
+    VNA can not report completion or does not within timeout seconds"""
+    if not session.wait_avg_complete(avg, timeout):
+        raise Exception('VNA did not complete averaging within {} s'.format(timeout))
+
+
+def measure(session, avg, timeout):
+    """Times a full measurement cycle on the connected VNA, which must already
+    be set up for the sweep. Returns the delays in the same form as
+    MeasurementCtrl.compute_vna_delay:
+        [averaging delay, get_data delay (S11), get_data delay (S21)]
+    where the averaging delay covers the averaging reset and avg sweeps.
+    Each wait for averaging lasts at most timeout seconds, after which an
+    Exception is raised"""
+    session.rst_avg('S11')
+    average(session, avg, timeout)
+    start = perf_counter()
+    session.get_data(0, 0, 'S11')
+    s11_delay = perf_counter() - start
+
+    start = perf_counter()
+    session.rst_avg('S21')
+    average(session, avg, timeout)
+    avg_delay = perf_counter() - start
+    start = perf_counter()
+    session.get_data(0, 0, 'S21')
+    s21_delay = perf_counter() - start
+
+    session.rst_avg('S21')
+    return [pad(avg_delay), pad(s11_delay), pad(s21_delay)]
@@ -0,0 +1,62 @@
+import numpy as np
+
+from measurement_ctrl.telemetry import TelemetryBuffer
+
+
+def fill(buffer, n):
+    for k in range(n):
+        buffer.append(float(k), k / 10, -k / 10, k)
+
+
+def begin_append(buffer, t):
+    """Starts an append the way the writer does, stopping after the time field"""
+    buffer.time[buffer.count % buffer.size] = t
+
+
+def test_snapshot_skips_slot_being_written():
+    buffer = TelemetryBuffer(size=8)
+    fill(buffer, 8)
+    begin_append(buffer, 8.0)
+    times, pan, tilt, status = buffer.snapshot()
+    assert len(times) == 7
+    assert list(times) == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]
+    assert np.allclose(pan, times / 10)
+    assert buffer.interpolate(4.5) is not None
+
+
+def test_snapshot_after_wrap_skips_slot_being_written():
+    buffer = TelemetryBuffer(size=8)
+    fill(buffer, 13)
+    begin_append(buffer, 13.0)
+    times, pan, tilt, status = buffer.snapshot()
+    assert list(times) == [6.0, 7.0, 8.0, 9.0, 10.0, 11.0, 12.0]
+    assert np.allclose(tilt, -times / 10)
+
+
+def test_latest_while_append_in_progress():
+    buffer = TelemetryBuffer(size=2)
+    fill(buffer, 3)
+    begin_append(buffer, 3.0)
+    assert buffer.latest() == (2.0, .2, -.2, 2)
+
+
+def test_snapshot_retries_when_writer_laps():
+    buffer = TelemetryBuffer(size=8)
+    fill(buffer, 8)
+    status = buffer.status
+
+    class Lapping(np.ndarray):
+        def __getitem__(self, index):
+            buffer.append(float(buffer.count), 0.0, 0.0, 0) # written during the copy
+            return np.ndarray.__getitem__(self, index)
+
+    buffer.status = status.view(Lapping)
+    try:
+        buffer.snapshot()
+    except Exception:
+        pass
+    else:
+        raise AssertionError('snapshot returned samples the writer overwrote')
+    buffer.status = status
+    times = buffer.snapshot()[0]
+    assert np.all(np.diff(times) == 1.0)